@@ -3,26 +3,44 @@
 
 import pandas as pd
 import re
+import hashlib
+import json
+import os
 from datetime import datetime
 import numpy as np
 from pathlib import Path
+import instrumentation
+from instrumentation import count, timed
+
+logger = instrumentation.get_logger('marker')
+
+# bump when the rule code changes in a way the patterns do not show, so old
+# label caches are dropped
+RULES_VERSION = 2
+# the only columns the series rules look at
+CLASSIFICATION_KEY = ['SeriesDescription', 'ProtocolName', 'Manufacturer', 'SpacingBetweenSlices', 'SliceSpacing']
+# slice spacing from the sidecar, else from the NIfTI header (metadata_sum --geometry)
+SPACING_COLUMNS = ['SpacingBetweenSlices', 'SliceSpacing']
 
 def combine_json(json_dir):
     json_dir = Path(json_dir)
-    df = pd.DataFrame()
+    frames = []
     for file_path in json_dir.glob('*.csv'):
         if file_path.name.startswith('.'):
             continue
         # First try UTF-8
-        sub_df = pd.read_csv(file_path, encoding='utf-8-sig', dtype=str)
-        df = pd.concat([df, sub_df], ignore_index=True)
+        frames.append(pd.read_csv(file_path, encoding='utf-8-sig', dtype=str))
+    # a single concat instead of growing the frame once per file
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
     df.dropna(inplace=True)
     df.to_csv(json_dir / 'summary_metadata.csv', index=False, encoding='utf-8-sig')
 
 class MAP_series_marker:
-    def __init__(self, df, marker='备注p'):
+    def __init__(self, df, marker='备注p', round_window_days=180, label_cache=None):
         self.df = df
         self.marker = marker    
+        self.round_window_days = round_window_days
+        self.label_cache = Path(label_cache) if label_cache else None
         self.sequence_patterns = {
             'T2': r'T2|t2_blade_tra_p2|Prop T2 TRF|T2 tra',
             'T2Flair': r'Flair|t2_tirm_tra_dark-fluid|t2_tirm_cor_dark-fluid|t2_tse_dark-fluid|OCor fs T2 FLAIR|t2_tra_dark-fluid_p3|T2_tse_dark_fluid_tra|T2_FLAIR_tra|t2_trim_tra_dark-fluid_p3|T2_trim_tra_dark-fluid',
@@ -51,16 +69,191 @@ class MAP_series_marker:
     def update_delete_pattern(self, new_pattern):
         self.delete_pattern = new_pattern
 
-    def map_series_rule(self):
+    @timed('marker.map_series_rule')
+    def map_series_rule(self, engine='vectorized'):
         self.df[self.marker] = ''
+        if engine == 'rowwise':
+            self._apply_sequence_rules_rowwise()
+            self._apply_manufacturer_rules_rowwise()
+            self._apply_3d_sequence_rules_rowwise()
+            self._apply_SWI_Pha_Mag_rules_rowwise()
+        else:
+            self.df[self.marker] = self.label_unique_keys()
+        self.study_round_naming_rule()
+        return self.df
+
+    def _apply_series_rules(self):
         self._apply_sequence_rules()
         self._apply_manufacturer_rules()
         self._apply_3d_sequence_rules()
         self._apply_SWI_Pha_Mag_rules()
-        self.study_round_naming_rule()
-        return self.df
 
+    def rules_hash(self):
+        # changes with any pattern, including edits through the update_* methods;
+        # the sequence order matters because later patterns win
+        rules = [RULES_VERSION, list(self.sequence_patterns.items()), self.others_pattern, self.delete_pattern]
+        return hashlib.sha256(json.dumps(rules, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def classify_keys(self, keys):
+        '''
+        run the vectorized rules on a table of unique key tuples, return the labels
+        '''
+        source = self.df
+        self.df = keys.reset_index(drop=True)
+        self.df[self.marker] = ''
+        try:
+            self._apply_series_rules()
+            labels = self.df[self.marker].to_numpy()
+        finally:
+            self.df = source
+        return labels
+
+    def load_label_cache(self, columns):
+        empty = pd.DataFrame(columns=columns + ['label'], dtype=object)
+        if self.label_cache is None or not self.label_cache.exists():
+            return empty
+        try:
+            with open(self.label_cache, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('unreadable label cache, starting empty', path=str(self.label_cache))
+            return empty
+        if cache.get('rules_hash') != self.rules_hash() or cache.get('columns') != columns:
+            logger.info('label cache is stale, starting empty', path=str(self.label_cache))
+            return empty
+        return pd.DataFrame(cache['labels'], columns=columns + ['label'], dtype=object)
+
+    def save_label_cache(self, table, columns):
+        # NaN keys are stored as null, numpy scalars as plain numbers
+        rows = table[columns + ['label']].astype(object)
+        rows = rows.where(rows.notna(), None).values.tolist()
+        cache = {'rules_hash': self.rules_hash(), 'columns': columns, 'labels': rows}
+        self.label_cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.label_cache.with_name(self.label_cache.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, default=lambda value: value.item())
+        os.replace(tmp_path, self.label_cache)
+
+    @timed('marker.label_unique_keys')
+    def label_unique_keys(self):
+        '''
+        classify each distinct key tuple once and broadcast the labels to the
+        rows; with label_cache set, only tuples missing from the cache are
+        classified and the cache is rewritten
+        '''
+        columns = [column for column in CLASSIFICATION_KEY if column in self.df]
+        keys = self.df[columns]
+        uniques = keys.drop_duplicates()
+        cached = self.load_label_cache(columns)
+        known = uniques.astype(object).merge(cached, on=columns, how='left')['label'].notna().to_numpy()
+        novel = uniques.loc[~known]
+        labelled = novel.astype(object).reset_index(drop=True)
+        labelled['label'] = self.classify_keys(novel.copy())
+        table = pd.concat([cached, labelled], ignore_index=True) if len(cached) else labelled
+        count('marker.keys_cached', int(known.sum()))
+        count('marker.keys_classified', len(novel))
+        logger.debug('series keys', unique=len(uniques), cached=int(known.sum()), classified=len(novel))
+        if self.label_cache is not None and len(novel):
+            self.save_label_cache(table, columns)
+        return keys.astype(object).merge(table, on=columns, how='left')['label'].to_numpy()
+
+    def check_parity(self):
+        '''
+        run the vectorized and the row-loop engines on copies of the table,
+        return the rows where the labels differ (empty when they agree)
+        '''
+        source = self.df
+        label_cache = self.label_cache
+        # compare the rules themselves, not what an older run cached
+        self.label_cache = None
+        labels = {}
+        for engine in ['vectorized', 'rowwise']:
+            self.df = source.copy()
+            labels[engine] = self.map_series_rule(engine=engine)[self.marker]
+        self.df = source
+        self.label_cache = label_cache
+        diff = labels['vectorized'] != labels['rowwise']
+        mismatches = source.loc[diff].copy()
+        mismatches['vectorized'] = labels['vectorized'][diff]
+        mismatches['rowwise'] = labels['rowwise'][diff]
+        return mismatches
+
+    def _as_str(self, column):
+        # same text the row loop sees through str(row[column])
+        return self.df[column].astype(object).map(str)
+
+    def _contains(self, text, pattern, flags=re.IGNORECASE):
+        return text.str.contains(re.compile(pattern, flags), regex=True).to_numpy(dtype=bool)
+
+    @timed('marker.apply_sequence_rules')
     def _apply_sequence_rules(self):
+        description = self.df['SeriesDescription'].astype(object)
+        description = description.where(description.notna(), self.df['ProtocolName'].astype(object))
+        description_str = description.map(str)
+        protocol_str = self._as_str('ProtocolName')
+        manufacturer_str = self._as_str('Manufacturer')
+
+        others = (self._contains(description_str, self.others_pattern) |
+                  self._contains(protocol_str, r"loc") |
+                  description_str.str.match(re.compile(r'^[A-Z]{5}$')).to_numpy(dtype=bool) |
+                  description.isin(['A', '2', 'HF']).to_numpy(dtype=bool))
+        delete = (self._contains(manufacturer_str, r"jpg|pjn") |
+                  self._contains(description_str, self.delete_pattern) |
+                  self._contains(protocol_str, self.delete_pattern))
+
+        # np.select picks the first true condition, so the priorities are listed
+        # highest first and the sequence patterns are reversed (later ones win)
+        conditions = [delete, others]
+        choices = ["delete", "Others"]
+        for sequence_type, pattern in reversed(list(self.sequence_patterns.items())):
+            conditions.append(self._contains(description_str, pattern))
+            choices.append(sequence_type)
+        self.df[self.marker] = np.select(conditions, choices, default=self.df[self.marker].astype(object))
+
+    @timed('marker.apply_SWI_Pha_Mag_rules')
+    def _apply_SWI_Pha_Mag_rules(self):
+        swi = (self.df[self.marker] == 'SWI').to_numpy(dtype=bool)
+        pha = self._contains(self._as_str('SeriesDescription'), r'PHA')
+        self.df.loc[swi & pha, self.marker] = "SWI_Pha"
+
+    @timed('marker.apply_manufacturer_rules')
+    def _apply_manufacturer_rules(self):
+        toshiba_patterns = {
+            'T2Flair': r'Flair',
+            'T2': r'T2',
+            'T1': r'T1'
+        }
+        label = self.df[self.marker]
+        candidates = ((self.df['Manufacturer'] == 'TOSHIBA_MEC') & ((label == '') | label.isna())).to_numpy(dtype=bool)
+        if not candidates.any():
+            return
+        protocol_str = self._as_str('ProtocolName')
+        conditions = []
+        choices = []
+        for sequence_type, pattern in reversed(list(toshiba_patterns.items())):
+            conditions.append(candidates & self._contains(protocol_str, pattern))
+            choices.append(sequence_type)
+        self.df[self.marker] = np.select(conditions, choices, default=label.astype(object))
+
+    @timed('marker.apply_3d_sequence_rules')
+    def _apply_3d_sequence_rules(self):
+        t1 = (self.df[self.marker] == 'T1').to_numpy(dtype=bool)
+        three_d = t1 & self._contains(self._as_str('SeriesDescription'),
+                                      r"iso|MPRAGE|3D|MP-RAGE|BRAVO|0.55mm|MultiPlanar Reconstruction|MPRAGE-2_6")
+        if not three_d.any():
+            return
+        # thick slices are a 2D acquisition despite the name; unknown spacing keeps 3DT1
+        spacing = self._slice_spacing()[three_d]
+        self.df.loc[three_d, self.marker] = np.where(spacing >= 1.5, "delete", "3DT1")
+
+    def _slice_spacing(self):
+        spacing = pd.Series(np.nan, index=self.df.index)
+        for column in SPACING_COLUMNS:
+            if column in self.df:
+                spacing = spacing.fillna(pd.to_numeric(self.df[column], errors='coerce'))
+        return spacing.to_numpy(dtype=float)
+
+    def _apply_sequence_rules_rowwise(self):
         for index, row in self.df.iterrows():
             # Apply main sequence patterns
             if pd.isna(row['SeriesDescription']):
@@ -83,11 +276,7 @@ class MAP_series_marker:
                 re.search(self.delete_pattern, str(row['ProtocolName']), re.IGNORECASE)):
                 self.df.at[index, self.marker] = "delete"
     
-    def _apply_SWI_Pha_Mag_rules(self):
-        pha_mag_patterns = {
-            'SWI_Pha':r'Pha_Images|FILT_PHA',
-            'SWI_Mag': r'Mag_Images',
-        }
+    def _apply_SWI_Pha_Mag_rules_rowwise(self):
         for index, row in self.df.iterrows():
             if row[self.marker] == 'SWI':
                 if re.search(r'PHA', str(row['SeriesDescription']), re.IGNORECASE):
@@ -95,7 +284,7 @@ class MAP_series_marker:
                 else:
                     self.df.at[index, self.marker] = "SWI"
 
-    def _apply_manufacturer_rules(self):
+    def _apply_manufacturer_rules_rowwise(self):
         toshiba_patterns = {
             'T2Flair': r'Flair',
             'T2': r'T2',
@@ -109,30 +298,54 @@ class MAP_series_marker:
                     if re.search(pattern, str(row['ProtocolName']), re.IGNORECASE):
                         self.df.at[index, self.marker] = sequence_type
 
-    def _apply_3d_sequence_rules(self):
+    def _apply_3d_sequence_rules_rowwise(self):
         for index, row in self.df.iterrows():
             if row[self.marker] == 'T1':
                 if re.search(r"iso|MPRAGE|3D|MP-RAGE|BRAVO|0.55mm|MultiPlanar Reconstruction|MPRAGE-2_6", 
                            str(row['SeriesDescription']), re.IGNORECASE):
-                        self.df.at[index, self.marker] = "3DT1" if row['SpacingBetweenSlices'] < 1.5 or row['SpacingBetweenSlices'] != None else "delete"
+                        self.df.at[index, self.marker] = "delete" if self._row_slice_spacing(row) >= 1.5 else "3DT1"
+
+    def _row_slice_spacing(self, row):
+        for column in SPACING_COLUMNS:
+            if column in row and pd.notna(pd.to_numeric(row[column], errors='coerce')):
+                return float(row[column])
+        return float('nan')
     
-    def study_round_naming_rule(self):
+    @timed('marker.study_round_naming_rule')
+    def study_round_naming_rule(self, window_days=None):
         '''
-        marking study round based on study date
+        marking study round based on study date, a study more than window_days
+        after the first study of the current round starts a new round
         '''
-        self.df['StudyRound'] = ''
-        ids = self.df['pid'].unique()
-        self.df['StudyDate'] = self.df['AcquisitionDateTime'].str[:10]
-        self.df['StudyDate'] = pd.to_datetime(self.df['StudyDate'], format='%Y-%m-%d')
-        for id in ids:
-            id_df = self.df[self.df['pid'] == id].sort_values('StudyDate')
-            round_num = 0
-            last_date = None
-            for date in id_df['StudyDate']:
-                if last_date is None or (date - last_date).days > 180:
-                    round_num += 1
-                    last_date = date
-                self.df.loc[(self.df['pid'] == id) & (self.df['StudyDate'] == date), 'StudyRound'] = "V" + str(round_num)
+        window_days = self.round_window_days if window_days is None else window_days
+        if 'AcquisitionDateTime' in self.df:
+            acquisition = self.df['AcquisitionDateTime'].astype('string')
+        else:
+            acquisition = pd.Series(pd.NA, index=self.df.index, dtype='string')
+        self.df['StudyDate'] = pd.to_datetime(acquisition.str[:10], format='%Y-%m-%d', errors='coerce')
+
+        # one sort over the unique (pid, date) visits, then a single scan that
+        # restarts the window at every new pid
+        visits = self.df.loc[self.df['pid'].notna() & self.df['StudyDate'].notna(), ['pid', 'StudyDate']]
+        visits = visits.drop_duplicates().sort_values(['pid', 'StudyDate'], kind='mergesort')
+        pids = visits['pid'].to_numpy()
+        dates = visits['StudyDate'].to_numpy()
+        window = np.timedelta64(window_days, 'D')
+        rounds = np.empty(len(visits), dtype=object)
+        round_num = 0
+        first_date = None
+        for i in range(len(visits)):
+            if i == 0 or pids[i] != pids[i - 1]:
+                round_num = 0
+                first_date = None
+            if first_date is None or dates[i] - first_date > window:
+                round_num += 1
+                first_date = dates[i]
+            rounds[i] = "V" + str(round_num)
+        visits['StudyRound'] = rounds
+
+        study_round = self.df[['pid', 'StudyDate']].merge(visits, on=['pid', 'StudyDate'], how='left')['StudyRound']
+        self.df['StudyRound'] = study_round.fillna('').to_numpy()
 
 
 if __name__ == "__main__":
@@ -142,10 +355,25 @@ if __name__ == "__main__":
     parser.add_argument('--input', type=str, help='input file path',required=True)
     parser.add_argument('--output', type=str, help='output file path',required=True)
     parser.add_argument('--marker',default='备注',help='marker column name')
+    parser.add_argument('--engine',default='vectorized',choices=['vectorized','rowwise'],help='rule engine')
+    parser.add_argument('--check_parity',action='store_true',help='compare the vectorized engine against the row loop and exit')
+    parser.add_argument('--round_window',type=int,default=180,help='days covered by one study round')
+    parser.add_argument('--label_cache',type=str,default=None,help='JSON file keeping the labels of already classified series keys between runs')
+
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
 
-    df = pd.read_csv(args.input,encoding='utf-8-sig')
-    marker = MAP_series_marker(df,marker='备注')
-    df = marker.map_series_rule()
-    df.to_csv(args.output, index=False, encoding='utf-8-sig')
\ No newline at end of file
+    with instrumentation.entry_point(args, 'marker') as logger:
+        df = pd.read_csv(args.input,encoding='utf-8-sig')
+        marker = MAP_series_marker(df,marker='备注',round_window_days=args.round_window,label_cache=args.label_cache)
+        if args.check_parity:
+            mismatches = marker.check_parity()
+            if not mismatches.empty:
+                mismatches.to_csv(args.output, index=False, encoding='utf-8-sig')
+                raise SystemExit(f'{len(mismatches)} rows differ between engines, written to {args.output}')
+            logger.info('vectorized and row-loop engines agree on all rows', rows=len(df))
+        else:
+            df = marker.map_series_rule(engine=args.engine)
+            count('marker.series_labelled', len(df))
+            df.to_csv(args.output, index=False, encoding='utf-8-sig')
@@ -0,0 +1,155 @@
+# Benchmark of the pipeline stages on synthetic data, reported as JSON so
+# regressions between revisions are visible
+
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from MAP_series_marker import MAP_series_marker
+from metadata_sum import get_metadata, sum_metadata
+from nii_selection import SeriesIndex, nii_selection
+from synthetic_data import generate_dataset
+
+
+def parse_scale(scale):
+    scale = scale.strip().lower()
+    if scale.endswith('k'):
+        return int(float(scale[:-1]) * 1000)
+    if scale.endswith('m'):
+        return int(float(scale[:-1]) * 1000000)
+    return int(scale)
+
+
+def current_rss():
+    # resident set size in bytes, Linux only
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return None
+
+
+class PeakMemory:
+    '''
+    samples the process RSS on a background thread; cheaper than tracemalloc,
+    which slows pandas-heavy stages several times over
+    '''
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stop = threading.Event()
+        self.baseline = current_rss()
+        self.peak = self.baseline
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        if self.baseline is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.baseline is not None:
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.peak, current_rss())
+
+
+def measure(name, n_series, func, quiet=True):
+    # wall time and peak RSS of one stage, stdout silenced
+    with open(os.devnull, 'w') as devnull, PeakMemory() as memory:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull) if quiet else contextlib.nullcontext():
+            result = func()
+        seconds = time.perf_counter() - start
+    stats = {'stage': name, 'seconds': round(seconds, 4),
+             'series_per_second': round(n_series / seconds, 1) if seconds else None}
+    if memory.baseline is not None:
+        stats['peak_rss_mb'] = round(memory.peak / 2**20, 2)
+        stats['peak_rss_growth_mb'] = round((memory.peak - memory.baseline) / 2**20, 2)
+    return result, stats
+
+
+def run_scale(n_series, work_dir, workers=1, link_mode='hardlink', seed=0):
+    work_dir = Path(work_dir)
+    source_dir = work_dir / 'nifti'
+    metadata_dir = work_dir / 'metadata'
+    output_dir = work_dir / 'selected'
+    start = time.perf_counter()
+    written = generate_dataset(source_dir, n_series=n_series, seed=seed)
+    generate_seconds = time.perf_counter() - start
+
+    stages = []
+    _, stats = measure('get_metadata', written, lambda: get_metadata(source_dir, metadata_dir, pattern=r'^\d+\+',
+                                                                      workers=workers))
+    stages.append(stats)
+    summary_df, stats = measure('sum_metadata', written, lambda: sum_metadata(metadata_dir, pattern=r'^\d+\+'))
+    stages.append(stats)
+    marker_df, stats = measure('map_series_rule', written,
+                               lambda: MAP_series_marker(summary_df, marker='备注').map_series_rule())
+    stages.append(stats)
+    marker_path = metadata_dir / 'marker_metadata.csv'
+    marker_df.to_csv(marker_path, index=False, encoding='utf-8-sig')
+
+    def select():
+        csv_index = SeriesIndex(pd.read_csv(marker_path, dtype=str, encoding='utf-8-sig'))
+        for hp_path in sorted(source_dir.iterdir()):
+            dst_path = output_dir / hp_path.name
+            dst_path.mkdir(parents=True, exist_ok=True)
+            nii_selection(hp_path, csv_index, r'^\d+\+\w+', dst_path).def_nii_file_with_type(
+                marker='备注', link_mode=link_mode)
+        return csv_index.stats()
+    index_stats, stats = measure('def_nii_file_with_type', written, select)
+    stats['index'] = index_stats
+    stages.append(stats)
+    return {'series': written, 'generate_seconds': round(generate_seconds, 3), 'stages': stages}
+
+
+def run_benchmark(scales, work_dir=None, workers=1, link_mode='hardlink', keep=False, seed=0):
+    report = {'python': platform.python_version(), 'pandas': pd.__version__, 'platform': platform.platform(),
+              'workers': workers, 'link_mode': link_mode, 'results': []}
+    for scale in scales:
+        n_series = parse_scale(scale)
+        scale_dir = Path(tempfile.mkdtemp(prefix=f'map_bench_{scale}_', dir=work_dir))
+        try:
+            result = run_scale(n_series, scale_dir, workers=workers, link_mode=link_mode, seed=seed)
+        finally:
+            if not keep:
+                shutil.rmtree(scale_dir, ignore_errors=True)
+        result['scale'] = scale
+        report['results'].append(result)
+        print(json.dumps(result))
+    report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time the pipeline stages on synthetic datasets.')
+    parser.add_argument('--scales', nargs='+', default=['1k', '10k', '100k'], help='dataset sizes in series')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='JSON report path')
+    parser.add_argument('--work_dir', type=str, default=None, help='where the synthetic datasets are written')
+    parser.add_argument('--workers', type=int, default=1, help='get_metadata worker processes')
+    parser.add_argument('--link_mode', default='hardlink', help='link mode for the selection stage')
+    parser.add_argument('--keep', action='store_true', help='keep the generated datasets')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+    args = parser.parse_args()
+
+    report = run_benchmark(args.scales, work_dir=args.work_dir, workers=args.workers, link_mode=args.link_mode,
+                           keep=args.keep, seed=args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Benchmark report written to {args.output}')
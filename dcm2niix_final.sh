@@ -4,6 +4,7 @@
 #   Subject ID + Subject Name
 #           ...
 #           Dicoms
+# For parallel, resumable conversion use dcm2niix_parallel.py instead
 
 # 获取输入参数
 SOURCE_DIR="/PATH/TO/DICOMS/DATASET"
@@ -37,14 +38,13 @@ for dir in "$SOURCE_DIR"/*; do
         if [ -d "$subdir" ]; then
             subdir_name=$(basename "$subdir")
             target_subdir="$TARGET_DIR/$hp_id+$hp_name/$subdir_name"
-            subbase_name=$(basename "$dir")
+            subbase_name=$(basename "$subdir")
             pid=$(echo "$subbase_name" | cut -d'+' -f1)
             pname=$(echo "$subbase_name" | cut -d'+' -f2-)
             mkdir -p "$target_subdir"
             echo "创建目标目录: $target_subdir"
             echo "处理目录: $subdir"
             dcm2niix -f "%s+%p+%t" -i y -d 9 -p n -z y -ba n -o "$target_subdir" "$subdir"
-            fi
         fi
     done
 done
@@ -0,0 +1,161 @@
+# Parallel dcm2niix driver, replaces dcm2niix_final.sh
+# Dataset should be format as
+# Center ID + Center Name
+#   Subject ID + Subject Name
+#           ...
+#           Dicoms
+
+import json
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import instrumentation
+import sharding
+from instrumentation import collect_counters, count, merge_counters, timed
+from sharding import directory_size
+
+logger = instrumentation.get_logger('dcm2niix')
+
+DCM2NIIX_OPTIONS = ['-f', '%s+%p+%t', '-i', 'y', '-d', '9', '-p', 'n', '-z', 'y', '-ba', 'n']
+
+
+def list_jobs(source_dir, target_dir):
+    # sources are absolute, they key the journal whichever way --source_dir is typed
+    jobs = []
+    for center in sorted(Path(os.path.abspath(source_dir)).iterdir()):
+        if not center.is_dir():
+            continue
+        hp_id = center.name.split('+')[0]
+        hp_name = center.name.split('+', 1)[1] if '+' in center.name else center.name
+        for subdir in sorted(center.iterdir()):
+            if subdir.is_dir():
+                jobs.append((str(subdir), str(Path(target_dir) / f'{hp_id}+{hp_name}' / subdir.name)))
+    return jobs
+
+
+def order_jobs(jobs, workers=8, sizes=None):
+    # largest patient directories first so the long conversions do not end up last
+    if sizes is None:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            sizes = list(executor.map(lambda job: directory_size(job[0]), jobs))
+    return [job for _, job in sorted(zip(sizes, jobs), key=lambda item: (-item[0], item[1]))]
+
+
+@timed('dcm2niix.convert')
+def convert(subdir, target_subdir, executable='dcm2niix', timeout=None, retries=1):
+    command = [executable] + DCM2NIIX_OPTIONS + ['-o', target_subdir, subdir]
+    start = time.time()
+    for attempt in range(1, retries + 2):
+        # start every attempt (and a resume after a crash) from an empty directory:
+        # dcm2niix would add a suffix to the names of the partial output left
+        # behind and the selection would pick up the suffixed duplicates
+        shutil.rmtree(target_subdir, ignore_errors=True)
+        os.makedirs(target_subdir, exist_ok=True)
+        try:
+            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout)
+            status = 'done' if result.returncode == 0 else 'failed'
+            message = result.stdout.decode('utf-8', errors='replace')[-2000:]
+        except subprocess.TimeoutExpired:
+            status, message = 'timeout', f'timed out after {timeout}s'
+        if status == 'done':
+            break
+    return {'source': subdir, 'target': target_subdir, 'status': status, 'attempts': attempt,
+            'seconds': round(time.time() - start, 3), 'message': message}
+
+
+def read_journal(journal_path):
+    done = set()
+    if Path(journal_path).exists():
+        with open(journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of a crashed run may be cut off
+                    continue
+                if entry.get('status') == 'done':
+                    done.add(os.path.abspath(entry['source']))
+    return done
+
+
+def run_conversions(source_dir, target_dir, workers=4, executable='dcm2niix', timeout=None, retries=1,
+                    journal_path=None, jobs=None, shard=None, balance='size', census=None):
+    '''
+    convert every patient directory with dcm2niix on a process pool, largest
+    first; finished directories are appended to a journal so a rerun resumes.
+    With shard=(i, N) only that shard's patients are converted, logged to a
+    journal of its own; every journal in the output is read on resume. census
+    is the census file all shards split by, None to count files here
+    '''
+    target_dir = Path(target_dir)
+    target_dir.mkdir(parents=True, exist_ok=True)
+    suffix = '' if shard is None else '.' + sharding.shard_name('dcm2niix', shard)
+    journal_path = Path(journal_path) if journal_path else target_dir / f'dcm2niix_journal{suffix}.jsonl'
+    if shutil.which(executable) is None:
+        raise FileNotFoundError(f'{executable} not found on PATH')
+
+    done = read_journal(journal_path)
+    # directories finished under another shard split count as well
+    for other_journal in target_dir.glob('dcm2niix_journal*.jsonl'):
+        if other_journal != journal_path:
+            done |= read_journal(other_journal)
+    source_dir = os.path.abspath(source_dir)
+    jobs = list_jobs(source_dir, target_dir) if jobs is None else [(os.path.abspath(subdir), target_subdir)
+                                                                      for subdir, target_subdir in jobs]
+    sizes = None
+    if shard is not None:
+        selected, selected_sizes, _ = sharding.select_shard(source_dir, shard, units=[Path(job[0]) for job in jobs],
+                                                            balance=balance, census_path=census)
+        selected = set(selected)
+        jobs = [job for job in jobs if Path(job[0]) in selected]
+        if balance == 'size':
+            sizes = [selected_sizes[Path(job[0])] for job in jobs if job[0] not in done]
+    pending = order_jobs([job for job in jobs if job[0] not in done], sizes=sizes)
+    logger.info('conversion jobs', directories=len(jobs), already_converted=len(jobs) - len(pending))
+
+    results = []
+    with open(journal_path, 'a', encoding='utf-8') as journal, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(collect_counters, convert, subdir, target_subdir, executable, timeout, retries)
+                   for subdir, target_subdir in pending]
+        for future in as_completed(futures):
+            result, worker_counters, worker_timings = future.result()
+            merge_counters(worker_counters, worker_timings)
+            count(f"dcm2niix.{result['status']}")
+            journal.write(json.dumps(result, ensure_ascii=False) + '\n')
+            journal.flush()
+            if result['status'] == 'done':
+                logger.debug('converted', source=result['source'], seconds=result['seconds'], attempts=result['attempts'])
+            else:
+                logger.warning('conversion failed', **result)
+            results.append(result)
+    failed = [result for result in results if result['status'] != 'done']
+    logger.info('conversion finished', converted=len(results) - len(failed), failed=len(failed))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert DICOM patient directories with dcm2niix in parallel.')
+    parser.add_argument('--source_dir', type=str, help='DICOM dataset path', required=True)
+    parser.add_argument('--output_dir', type=str, help='NIfTI output path', required=True)
+    parser.add_argument('--workers', type=int, default=4, help='number of concurrent dcm2niix processes')
+    parser.add_argument('--timeout', type=float, default=None, help='seconds before a dcm2niix call is killed')
+    parser.add_argument('--retries', type=int, default=1, help='retries for a failed or timed out directory')
+    parser.add_argument('--dcm2niix', type=str, default='dcm2niix', help='dcm2niix executable')
+    parser.add_argument('--journal', type=str, default=None, help='completion journal (default OUTPUT_DIR/dcm2niix_journal.jsonl)')
+    sharding.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    with instrumentation.entry_point(args, 'dcm2niix'):
+        results = run_conversions(args.source_dir, args.output_dir, workers=args.workers, executable=args.dcm2niix,
+                                  timeout=args.timeout, retries=args.retries, journal_path=args.journal,
+                                  shard=args.shard, balance=args.balance, census=args.census)
+    if any(result['status'] != 'done' for result in results):
+        raise SystemExit(1)
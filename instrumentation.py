@@ -0,0 +1,147 @@
+# Shared logging, counters, timers and profiling for the entry points
+#
+# Everything is off until configure() is called with a level other than
+# 'off': count() and @timed then return after a single flag check.
+
+import cProfile
+import functools
+import json
+import logging
+import pstats
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+LEVELS = ['off', 'debug', 'info', 'warning', 'error']
+
+counters = Counter()
+timings = {}
+_enabled = False
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(),
+                 'logger': record.name, 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    # logger.info('msg', key=value) puts the keywords in the JSON line; the
+    # level check happens before any of them is formatted
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs)
+                  if key not in ('exc_info', 'stack_info', 'stacklevel', 'extra')}
+        kwargs['extra'] = {'fields': fields}
+        return msg, kwargs
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(f'map.{name}'), {})
+
+
+def configure(level='info', log_file=None):
+    global _enabled
+    root = logging.getLogger('map')
+    root.handlers = []
+    root.propagate = False
+    if level == 'off':
+        _enabled = False
+        root.setLevel(logging.CRITICAL + 1)
+        return
+    _enabled = True
+    handler = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, level.upper()))
+
+
+def enabled():
+    return _enabled
+
+
+def count(name, n=1):
+    if _enabled:
+        counters[name] += n
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                total, calls = timings.get(name, (0.0, 0))
+                timings[name] = (total + time.perf_counter() - start, calls + 1)
+        return wrapper
+    return decorator
+
+
+def collect_counters(func, *args):
+    # run func in a pool worker and hand its counters back to the parent
+    counters.clear()
+    timings.clear()
+    result = func(*args)
+    return result, dict(counters), dict(timings)
+
+
+def merge_counters(worker_counters, worker_timings):
+    if not _enabled:
+        return
+    counters.update(worker_counters)
+    for name, (seconds, calls) in worker_timings.items():
+        total, total_calls = timings.get(name, (0.0, 0))
+        timings[name] = (total + seconds, total_calls + calls)
+
+
+def log_summary(logger):
+    if not _enabled:
+        return
+    logger.info('counters', counters=dict(counters))
+    logger.info('timers', timers={name: {'seconds': round(seconds, 4), 'calls': calls}
+                                  for name, (seconds, calls) in timings.items()})
+
+
+def add_arguments(parser):
+    parser.add_argument('--log_level', default='info', choices=LEVELS, help='JSON-lines log level, off disables logging and counters')
+    parser.add_argument('--log_file', default=None, help='write the JSON-lines log here instead of stderr')
+    parser.add_argument('--profile', default=None, help='dump cProfile stats of the whole run to this file')
+
+
+@contextmanager
+def profiled(path=None, top=30):
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(top)
+
+
+@contextmanager
+def entry_point(args, name):
+    '''
+    configure logging from the CLI arguments, run the body under the optional
+    profiler and log the counters and timers at the end
+    '''
+    configure(args.log_level, args.log_file)
+    logger = get_logger(name)
+    with profiled(args.profile):
+        start = time.perf_counter()
+        yield logger
+        if _enabled:
+            logger.info('finished', seconds=round(time.perf_counter() - start, 3))
+        log_summary(logger)
@@ -0,0 +1,102 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def source_key(path):
+    # absolute, so a run started with a relative --source_dir finds the
+    # entries of one started with the absolute path (and the other way round)
+    return os.path.abspath(os.fspath(path))
+
+
+def group_matches(entries, signatures):
+    # entries as returned by Manifest.group; usable in a worker process that
+    # has no connection of its own
+    signatures = {source_key(source): signature for source, signature in signatures.items()}
+    if set(entries) != set(signatures):
+        return False
+    for source, signature in signatures.items():
+        size, mtime_ns, output = entries[source]
+        if (size, mtime_ns) != tuple(signature) or (output and not os.path.exists(output)):
+            return False
+    return True
+
+
+class Manifest:
+    '''
+    sqlite record of every source file a stage has processed: its size and
+    mtime, the group (patient) it belongs to and the output it produced
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries ('
+                          'stage TEXT, source TEXT, grp TEXT, size INTEGER, mtime_ns INTEGER, output TEXT, info TEXT, '
+                          'PRIMARY KEY (stage, source))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_grp ON entries (stage, grp)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (stage TEXT, key TEXT, value TEXT, PRIMARY KEY (stage, key))')
+        self.conn.commit()
+
+    def reset(self, stage):
+        self.conn.execute('DELETE FROM entries WHERE stage = ?', (stage,))
+        self.conn.execute('DELETE FROM meta WHERE stage = ?', (stage,))
+        self.conn.commit()
+
+    def get(self, stage, source):
+        row = self.conn.execute('SELECT size, mtime_ns, output, info FROM entries WHERE stage = ? AND source = ?',
+                                (stage, source_key(source))).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, output, info = row
+        return {'size': size, 'mtime_ns': mtime_ns, 'output': output, 'info': json.loads(info) if info else None}
+
+    def is_current(self, stage, source, signature):
+        # unchanged source whose output (if any) is still on disk
+        entry = self.get(stage, source)
+        if entry is None or (entry['size'], entry['mtime_ns']) != tuple(signature):
+            return False
+        return not entry['output'] or os.path.exists(entry['output'])
+
+    def group(self, stage, grp):
+        rows = self.conn.execute('SELECT source, size, mtime_ns, output FROM entries WHERE stage = ? AND grp = ?',
+                                 (stage, source_key(grp))).fetchall()
+        return {source: (size, mtime_ns, output) for source, size, mtime_ns, output in rows}
+
+    def record(self, stage, source, signature, output=None, grp=None, info=None):
+        self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+                          (stage, source_key(source), None if grp is None else source_key(grp), signature[0], signature[1],
+                           '' if output is None else source_key(output), None if info is None else json.dumps(info)))
+
+    def record_group(self, stage, grp, signatures, output=None):
+        self.conn.execute('DELETE FROM entries WHERE stage = ? AND grp = ?', (stage, source_key(grp)))
+        for source, signature in signatures.items():
+            self.record(stage, source, signature, output=output, grp=grp)
+        self.conn.commit()
+
+    def forget_missing(self, stage, sources):
+        keep = {source_key(source) for source in sources}
+        rows = self.conn.execute('SELECT source FROM entries WHERE stage = ?', (stage,)).fetchall()
+        for (source,) in rows:
+            if source not in keep:
+                self.conn.execute('DELETE FROM entries WHERE stage = ? AND source = ?', (stage, source))
+
+    def get_value(self, stage, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE stage = ? AND key = ?', (stage, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_value(self, stage, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?)', (stage, key, json.dumps(value)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
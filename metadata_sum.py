@@ -1,83 +1,363 @@
-import json
 import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 import re 
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from manifest import Manifest, file_signature, group_matches, source_key
+from sidecar_io import SidecarIndex, is_fallback, load_sidecar
+from nifti_geometry import sidecar_geometry
+import instrumentation
+from instrumentation import collect_counters, count, merge_counters, timed
 
-def get_metadata(src_path,destination_dir,pattern=r'^\d+\+\w+',split_char="+"):
+logger = instrumentation.get_logger('metadata')
+
+def list_sidecars(pid):
+    sidecars = [file_path for file_path in sorted(Path(pid).glob('**/*.json')) if not file_path.name.startswith('.')]
+    count('metadata.files_scanned', len(sidecars))
+    return sidecars
+
+@timed('metadata.extract_patient')
+def extract_patient_metadata(pid, destination_dir, pattern=r'^\d+\+\w+', split_char="+", sidecars=None, return_frame=False, geometry=False, index=None):
+    pid = Path(pid)
+    metadata = []
+    for file_path in (list_sidecars(pid) if sidecars is None else sidecars):
+        data, encoding = load_sidecar(file_path, index=index)
+        if data is None:
+            count('metadata.sidecars_skipped')
+            continue
+        if is_fallback(encoding):
+            count('metadata.decode_fallbacks')
+        count('metadata.sidecars_parsed')
+        if geometry:
+            data.update(sidecar_geometry(file_path))
+        metadata.append(data)
+    if metadata:
+        df = pd.DataFrame(metadata)
+        # Check for pattern like "123+Name"
+        if re.match(pattern, pid.name):
+            if split_char == '+':
+                df['pid'] = pid.name.split('+')[0]
+                df['pName'] = pid.name.split('+')[1]
+            elif split_char == '-':
+                df['hpid'] = pid.name.split('-')[1]
+                df['pid'] = pid.name.split('-')[2]
+            else:
+                df['pid'] = re.match(pattern, pid.name).group(0)
+                df['pName'] = pid.name[len(df['pid']):].strip()
+            output_path = Path(destination_dir) / f"{pid.name}_metadata.csv"
+            df.to_csv(output_path, index=False, encoding='utf-8-sig')
+            return (output_path, df) if return_frame else output_path
+    return (None, None) if return_frame else None
+
+def process_patient(pid, destination_dir, pattern, split_char, return_frame, geometry, known=None, index_fields=None):
+    '''
+    list and stat the patient's sidecars where the work runs (a pool worker);
+    known is the manifest group of the last run, when every sidecar still
+    matches it the patient is reported unchanged instead of being parsed.
+    Returns (unchanged, signatures, result of extract_patient_metadata,
+    SidecarIndex entries of index_fields for the sidecars parsed)
+    '''
+    sidecars = list_sidecars(pid)
+    signatures = {str(file_path): file_signature(file_path) for file_path in sidecars}
+    if known is not None and group_matches(known, signatures):
+        count('metadata.patients_unchanged')
+        return True, signatures, None, {}
+    index = SidecarIndex(index_fields) if index_fields else None
+    result = extract_patient_metadata(pid, destination_dir, pattern, split_char, sidecars, return_frame, geometry, index)
+    return False, signatures, result, index.entries if index is not None else {}
+
+def get_metadata(src_path,destination_dir,pattern=r'^\d+\+\w+',split_char="+",workers=1,max_in_flight=None,manifest=None,collect=False,geometry=False,include=None,index=None):
+    '''
+    write one {pid}_metadata.csv per patient; with collect the per-patient
+    frames are also returned, in the order sum_metadata reads the CSVs.
+    A SidecarIndex given as index is filled with its fields of every sidecar parsed
+    '''
     source_dir = Path(src_path)
     destination_dir = Path(destination_dir)
+    include = None if include is None else {Path(pid) for pid in include}
     if not destination_dir.exists():
         destination_dir.mkdir(parents=True)
 
-    for hpf in tqdm(source_dir.iterdir(), desc='Center progress Loop', leave=True):
-        if hpf.is_dir():
-            for pid in tqdm(hpf.iterdir(), desc=f'{hpf.name} Patient Loop', leave=False):
-                if pid.is_dir():
-                    metadata = []
-                    for file_path in pid.glob('**/*.json'):
-                        if file_path.name.startswith('.'):
-                            continue
-                        try:
-                            # First try UTF-8
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                data = json.load(f)
-                        except UnicodeDecodeError:
-                            try:
-                                # If UTF-8 fails, try GBK
-                                with open(file_path, 'r', encoding='gbk') as f:
-                                    data = json.load(f)
-                            except:
-                                # If both fail, skip this file
-                                continue
-                        metadata.append(data)
-                    if metadata:
-                        df = pd.DataFrame(metadata)
-                        # Check for pattern like "123+Name"
-                        if re.match(pattern, pid.name):
-                            if split_char == '+':
-                                df['pid'] = pid.name.split('+')[0]
-                                df['pName'] = pid.name.split('+')[1]
-                            elif split_char == '-':
-                                df['hpid'] = pid.name.split('-')[1]
-                                df['pid'] = pid.name.split('-')[2]
-                            else:
-                                df['pid'] = re.match(pattern, pid.name).group(0)
-                                df['pName'] = pid.name[len(df['pid']):].strip()
-                            df.to_csv(destination_dir / f"{pid.name}_metadata.csv", index=False, encoding='utf-8-sig')
-
-def sum_metadata(metadata_dir,pattern=r'^\d+\+\w+'):
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        # keep a bounded number of patients queued so memory stays flat
+        max_in_flight = max_in_flight or workers * 4
+    else:
+        executor = None
+    frames = {}
+    in_flight = {}
+
+    def worker_result(future):
+        result, worker_counters, worker_timings = future.result()
+        merge_counters(worker_counters, worker_timings)
+        return result
+
+    def finish(pid, known, processed):
+        unchanged, signatures, result, entries = processed
+        if index is not None:
+            index.update(entries)
+        if unchanged:
+            if collect:
+                outputs = {output for _, _, output in known.values() if output}
+                for output_path in outputs:
+                    frames[Path(output_path).name] = pd.read_csv(output_path)
+            return
+        output_path = result
+        if collect:
+            output_path, df = result
+            if output_path is not None:
+                frames[output_path.name] = df
+        if manifest is not None:
+            manifest.record_group('metadata', pid, signatures, output=output_path)
+
+    centers = [hpf for hpf in sorted(source_dir.iterdir()) if hpf.is_dir()]
+    center_progress = tqdm(total=len(centers), desc='Center progress Loop', leave=True)
+    # one patient bar per center still being processed, a pool works on the
+    # next center while the last patients of the previous one finish
+    progress = {}
+    remaining = {}
+
+    def center_done(hpf):
+        progress.pop(hpf).close()
+        center_progress.update(1)
+
+    def patient_done(hpf):
+        progress[hpf].update(1)
+        remaining[hpf] -= 1
+        if not remaining[hpf]:
+            center_done(hpf)
+
+    try:
+        for hpf in centers:
+            patients = [pid for pid in sorted(hpf.iterdir()) if pid.is_dir() and (include is None or pid in include)]
+            progress[hpf] = tqdm(total=len(patients), desc=f'{hpf.name} Patient Loop', leave=False)
+            remaining[hpf] = len(patients)
+            if not patients:
+                center_done(hpf)
+            for pid in patients:
+                # only the manifest lookup happens here, the directory walk
+                # and the stat calls run in the worker
+                known = manifest.group('metadata', pid) if manifest is not None else None
+                job = (pid, destination_dir, pattern, split_char, collect, geometry, known,
+                       index.fields if index is not None else None)
+                if executor is None:
+                    finish(pid, known, process_patient(*job))
+                    patient_done(hpf)
+                    continue
+                # a single bound on the patients queued, across centers
+                if len(in_flight) >= max_in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pid_done, known_done, hpf_done = in_flight.pop(future)
+                        finish(pid_done, known_done, worker_result(future))
+                        patient_done(hpf_done)
+                in_flight[executor.submit(collect_counters, process_patient, *job)] = (pid, known, hpf)
+        for future in as_completed(in_flight):
+            pid, known, hpf = in_flight[future]
+            finish(pid, known, worker_result(future))
+            patient_done(hpf)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        for bar in progress.values():
+            bar.close()
+        center_progress.close()
+    if collect:
+        return [frames[name] for name in sorted(frames)]
+
+SUMMARY_CATEGORIES = ['Manufacturer', 'ProtocolName', 'SeriesDescription']
+
+@timed('summary.profile_csv')
+def profile_metadata_csv(file_path):
+    # first pass: row count, per-column non-null counts and the category values
+    df = pd.read_csv(file_path, dtype={c: str for c in SUMMARY_CATEGORIES})
+    categories = {c: set(df[c].dropna()) for c in SUMMARY_CATEGORIES if c in df}
+    return len(df), df.notna().sum(), categories
+
+@timed('summary.read_columns')
+def read_summary_columns(file_path, columns, category_dtypes):
+    # second pass: only the surviving columns, with categoricals for the repeated strings
+    keep = set(columns)
+    df = pd.read_csv(file_path, usecols=lambda c: c in keep,
+                     dtype={c: t for c, t in category_dtypes.items() if c in keep})
+    df = df.reindex(columns=columns)
+    for c, t in category_dtypes.items():
+        if c in keep and df[c].dtype != t:
+            df[c] = df[c].astype(t)
+    return df
+
+def write_summary(summary_df, output_dir, formats=('csv',), name='summary_metadata'):
+    # returns the paths actually written
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+    for fmt in formats:
+        output_path = output_dir / f'{name}.{fmt}'
+        try:
+            if fmt == 'csv':
+                summary_df.to_csv(output_path, index=False, encoding='utf-8-sig')
+            elif fmt == 'parquet':
+                summary_df.to_parquet(output_path, index=False)
+            elif fmt == 'feather':
+                summary_df.reset_index(drop=True).to_feather(output_path)
+            else:
+                logger.warning('unknown summary format, skipped', format=fmt)
+                continue
+            written.append(output_path)
+        except ImportError as e:
+            logger.warning('cannot write summary', path=str(output_path), error=str(e))
+    return written
+
+def summarize_frames(frames):
+    # in-memory counterpart of sum_metadata for frames that are already loaded
+    n_rows = sum(len(df) for df in frames)
+    non_null = {}
+    for df in frames:
+        for column, count in df.notna().sum().items():
+            non_null[column] = non_null.get(column, 0) + int(count)
+    columns = [column for column, count in non_null.items() if count >= n_rows*0.5]
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    summary_df = pd.concat([df.reindex(columns=columns) for df in frames], ignore_index=True)
+    for c in SUMMARY_CATEGORIES:
+        if c in summary_df:
+            summary_df[c] = summary_df[c].astype('category')
+    return summary_df
+
+def read_previous_summary(manifest, columns, category_dtypes):
+    '''
+    the summary the last run wrote, but only the exact file it recorded and
+    only while that file is unchanged; a summary of another format left over
+    from an older run is never used
+    '''
+    previous = manifest.get_value('summary', 'previous')
+    if previous is None:
+        return None
+    summary_path, signature = Path(previous[0]), previous[1]
+    if not summary_path.exists() or list(file_signature(summary_path)) != signature:
+        return None
+    try:
+        if summary_path.suffix == '.parquet':
+            return pd.read_parquet(summary_path).reindex(columns=columns).astype(category_dtypes)
+        if summary_path.suffix == '.feather':
+            return pd.read_feather(summary_path).reindex(columns=columns).astype(category_dtypes)
+    except ImportError:
+        return None
+    return read_summary_columns(summary_path, columns, category_dtypes)
+
+def sum_metadata(metadata_dir,pattern=r'^\d+\+\w+',formats=('csv',),manifest=None,files=None):
     metadata_dir = Path(metadata_dir)
-    summary_df = pd.DataFrame()
-    for file_path in metadata_dir.glob('*.csv'):
-        if re.match(pattern,file_path.name):
-            df = pd.read_csv(file_path)
-            summary_df = pd.concat([summary_df, df], ignore_index=True)
+    # files restricts the summary to given per-patient CSVs (the outputs of a sharded run)
+    files = sorted(metadata_dir.glob('*.csv')) if files is None else sorted(Path(file_path) for file_path in files)
+    files = [file_path for file_path in files if re.match(pattern,file_path.name)]
+
+    n_rows = 0
+    non_null = {}
+    categories = {c: set() for c in SUMMARY_CATEGORIES}
+    profiles = {}
+    changed = set()
+    for file_path in tqdm(files, desc='Summary pass 1', leave=False):
+        signature = file_signature(file_path)
+        entry = manifest.get('summary', file_path) if manifest is not None else None
+        if entry is not None and (entry['size'], entry['mtime_ns']) == signature:
+            # unchanged per-patient CSV, reuse its profile from the last run
+            rows, counts, values = entry['info']['rows'], entry['info']['counts'], entry['info']['categories']
+        else:
+            rows, counts, values = profile_metadata_csv(file_path)
+            counts = {column: int(count) for column, count in counts.items()}
+            values = {column: sorted(value) for column, value in values.items()}
+            changed.add(file_path)
+        profiles[file_path] = (signature, rows, counts, values)
+        n_rows += rows
+        for column, count in counts.items():
+            non_null[column] = non_null.get(column, 0) + count
+        for column, value in values.items():
+            categories[column].update(value)
 
     # summary_df = summary_df.drop_duplicates()  # Remove duplicate rows
-    summary_df = summary_df.dropna(axis=1, thresh=len(summary_df)*0.5)  # Drop columns with >50% NaN
-    summary_df.to_csv(metadata_dir / 'summary_metadata.csv', index=False, encoding='utf-8-sig')
+    # Drop columns with >50% NaN
+    columns = [column for column, count in non_null.items() if count >= n_rows*0.5]
+    category_dtypes = {c: pd.CategoricalDtype(sorted(categories[c])) for c in SUMMARY_CATEGORIES if c in columns}
+
+    # merge the delta into the previous summary when its columns still apply
+    previous = None
+    if manifest is not None and manifest.get_value('summary', 'columns') == columns:
+        previous = read_previous_summary(manifest, columns, category_dtypes)
+        if previous is not None and len(previous) != manifest.get_value('summary', 'rows'):
+            previous = None
+    frames = []
+    for file_path in tqdm(files, desc='Summary pass 2', leave=False):
+        entry = manifest.get('summary', file_path) if previous is not None and file_path not in changed else None
+        if entry is not None and entry['info'].get('start') is not None:
+            start = entry['info']['start']
+            frames.append(previous.iloc[start:start + entry['info']['rows']])
+        else:
+            frames.append(read_summary_columns(file_path, columns, category_dtypes))
+    summary_df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    written = write_summary(summary_df, metadata_dir, formats)
+
+    if manifest is not None:
+        start = 0
+        for file_path in files:
+            signature, rows, counts, values = profiles[file_path]
+            manifest.record('summary', file_path, signature,
+                            info={'rows': rows, 'counts': counts, 'categories': values, 'start': start})
+            start += rows
+        manifest.forget_missing('summary', files)
+        manifest.set_value('summary', 'columns', columns)
+        manifest.set_value('summary', 'rows', len(summary_df))
+        # the binary formats are faster to reread than the CSV
+        written.sort(key=lambda path: path.suffix == '.csv')
+        manifest.set_value('summary', 'previous',
+                           [source_key(written[0]), list(file_signature(written[0]))] if written else None)
+        manifest.commit()
+    return summary_df
 
 
 
 if __name__ == '__main__':
 
     import argparse
+    import sharding
 
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--source_dir', type=str, help='input file path',required=True)
     parser.add_argument('--output_dir', type=str, help='output file path',required=True)
     parser.add_argument('--pattern',default=r'^\d+\+',help='file name pattern')
     parser.add_argument('--split_char',default="+",help='file name split char')
+    parser.add_argument('--workers',type=int,default=1,help='number of processes reading patient directories')
+    parser.add_argument('--formats',nargs='+',default=['csv'],choices=['csv','parquet','feather'],help='summary output formats')
+    parser.add_argument('--full',action='store_true',help='ignore the manifest and rebuild everything')
+    parser.add_argument('--geometry',action='store_true',help='add shape, voxel size and slice spacing from the NIfTI headers')
+    sharding.add_arguments(parser)
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
 
-    source_dir = Path(args.source_dir)
-    destination_dir = Path(args.output_dir)
-    print('Please check pattern and split character are wrote in correct way, current pattern is {}, split char is {}'.format(args.pattern,args.split_char))
-    get_metadata(source_dir,destination_dir,pattern=args.pattern,split_char=args.split_char)
-    sum_metadata(destination_dir,pattern=args.pattern)
-
-
-
-
+    with instrumentation.entry_point(args, 'metadata') as logger:
+        source_dir = Path(args.source_dir)
+        destination_dir = Path(args.output_dir)
+        # check pattern and split character are wrote in correct way
+        logger.info('settings', pattern=args.pattern, split_char=args.split_char)
+        include = None
+        manifest_name = 'manifest.sqlite'
+        if args.shard is not None:
+            include, _, census_digest = sharding.select_shard(source_dir, args.shard, balance=args.balance,
+                                                                census_path=args.census)
+            # concurrent shards share the output directory but not a manifest
+            manifest_name = f'manifest.{sharding.shard_name("metadata", args.shard)}.sqlite'
+        manifest = Manifest(destination_dir / manifest_name)
+        if args.full or bool(manifest.get_value('metadata', 'geometry')) != args.geometry:
+            # the per-patient CSVs gain or lose the geometry columns
+            manifest.reset('metadata')
+            manifest.reset('summary')
+        manifest.set_value('metadata', 'geometry', args.geometry)
+        get_metadata(source_dir,destination_dir,pattern=args.pattern,split_char=args.split_char,workers=args.workers,manifest=manifest,geometry=args.geometry,include=include)
+        if args.shard is None:
+            sum_metadata(destination_dir,pattern=args.pattern,formats=args.formats,manifest=manifest)
+        else:
+            # the summary is built once all shards are done: python sharding.py metadata
+            manifest.commit()
+            outputs = [f'{pid.name}_metadata.csv' for pid in include if (destination_dir / f'{pid.name}_metadata.csv').exists()]
+            sharding.write_shard_file(destination_dir, 'metadata', args.shard, census_digest, source_dir, include, outputs=sorted(outputs))
+        manifest.close()
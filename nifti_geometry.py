@@ -0,0 +1,86 @@
+# Image geometry of the NIfTI series from their headers only
+#
+# nibabel's load() parses the 348 byte header and leaves the voxel data behind
+# a lazy proxy, so for .nii.gz only the first gzip block is ever inflated.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import nibabel as nib
+import pandas as pd
+
+import instrumentation
+from instrumentation import count, timed
+
+logger = instrumentation.get_logger('geometry')
+
+GEOMETRY_COLUMNS = ['ImageShape', 'VoxelSize', 'SliceCount', 'SliceSpacing', 'Volumes']
+
+
+def nifti_for_sidecar(json_path):
+    # dcm2niix writes {stem}.json next to {stem}.nii.gz (or .nii without -z y)
+    stem = os.fspath(json_path)[:-len('.json')]
+    for extension in ('.nii.gz', '.nii'):
+        if os.path.exists(stem + extension):
+            return stem + extension
+    return None
+
+
+@timed('geometry.read_header')
+def read_geometry(nii_path):
+    '''
+    shape, voxel size, slice count, slice spacing and volume count of one
+    series; empty dict when the header cannot be read
+    '''
+    try:
+        header = nib.load(nii_path).header
+    except Exception as e:
+        count('geometry.unreadable')
+        logger.warning('cannot read NIfTI header', path=str(nii_path), error=str(e))
+        return {}
+    shape = header.get_data_shape()
+    zooms = header.get_zooms()
+    count('geometry.headers_read')
+    return {
+        'ImageShape': 'x'.join(str(size) for size in shape),
+        'VoxelSize': 'x'.join(f'{size:g}' for size in zooms[:3]),
+        'SliceCount': int(shape[2]) if len(shape) > 2 else 1,
+        'SliceSpacing': round(float(zooms[2]), 6) if len(zooms) > 2 else None,
+        'Volumes': int(shape[3]) if len(shape) > 3 else 1,
+    }
+
+
+def sidecar_geometry(json_path):
+    nii_path = nifti_for_sidecar(json_path)
+    if nii_path is None:
+        count('geometry.missing_nifti')
+        return {}
+    return read_geometry(nii_path)
+
+
+def geometry_table(root, workers=8):
+    '''
+    geometry of every NIfTI file under root, read on a thread pool (gzip
+    releases the GIL while inflating the header block)
+    '''
+    paths = sorted(str(path) for path in Path(root).rglob('*.nii*')
+                   if path.name.endswith(('.nii', '.nii.gz')) and not path.name.startswith('._'))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        rows = [dict(path=path, **geometry) for path, geometry in zip(paths, executor.map(read_geometry, paths))]
+    return pd.DataFrame(rows, columns=['path'] + GEOMETRY_COLUMNS)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Read the geometry of every NIfTI file from its header.')
+    parser.add_argument('--source_dir', type=str, help='NIfTI dataset path', required=True)
+    parser.add_argument('--output', type=str, help='output CSV path', required=True)
+    parser.add_argument('--workers', type=int, default=8, help='number of reader threads')
+    instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    with instrumentation.entry_point(args, 'geometry'):
+        geometry_table(args.source_dir, workers=args.workers).to_csv(args.output, index=False, encoding='utf-8-sig')
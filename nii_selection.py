@@ -1,46 +1,195 @@
 import nibabel as nib
 import pandas as pd
+import numpy as np
 import re
 import os
 from pathlib import Path
-import json
 import shutil
+from manifest import Manifest, file_signature
+from sidecar_io import is_fallback, load_sidecar
+from series_transfer import LINK_MODES, TransferQueue, write_plan
+from series_dedup import DEDUP_MODES, SeriesDeduplicator
+import instrumentation
+from instrumentation import count, timed
+
+logger = instrumentation.get_logger('selection')
+
+MATCH_FIELDS = ['SeriesDescription', 'ProtocolName', 'Manufacturer', 'SeriesInstanceUID']
+FALLBACK_FIELDS = ('SeriesDescription', 'ProtocolName', 'Manufacturer')
+# all the selection reads from a sidecar
+SIDECAR_FIELDS = MATCH_FIELDS + ['SeriesNumber']
+
+def split_extension(name):
+    if name.endswith('.nii.gz'):
+        return name[:-7], '.nii.gz'
+    return os.path.splitext(name)
+
+
+@timed('selection.scan_series')
+def scan_series(p_path):
+    '''
+    walk a patient directory once with os.scandir and return
+    {series path without extension: set of sibling extensions}, keeping
+    only series that have a .nii.gz or .nii image
+    '''
+    siblings = {}
+    stack = [str(p_path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in reversed(entries):
+            if entry.is_dir():
+                stack.append(entry.path)
+            elif entry.is_file() and not entry.name.startswith('._'):
+                count('selection.files_scanned')
+                stem, extension = split_extension(entry.name)
+                siblings.setdefault(os.path.join(os.path.dirname(entry.path), stem), set()).add(extension)
+    return {stem: extensions for stem, extensions in sorted(siblings.items())
+            if '.nii.gz' in extensions or '.nii' in extensions}
+
+
+def as_marker_table(df, marker=None):
+    '''
+    the marker table as nii_selection sees it when read back from CSV with
+    dtype=str: text values, dates as YYYY-MM-DD, empty strings as NaN
+    '''
+    def as_text(value):
+        if isinstance(value, str):
+            return value if value != '' else np.nan
+        if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NaT:
+            return np.nan
+        return str(value)
+
+    columns = [c for c in MATCH_FIELDS + ['StudyRound', 'StudyDate', marker] if c in df] if marker else list(df.columns)
+    table = pd.DataFrame(index=df.index)
+    for column in columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime('%Y-%m-%d')
+        table[column] = values.astype(object).map(as_text)
+    return table.reset_index(drop=True)
+
+
+class SeriesIndex:
+    '''
+    hash index over the marker table, keyed on SeriesInstanceUID with a
+    fallback on the (SeriesDescription, ProtocolName, Manufacturer) tuple
+    '''
+    def __init__(self, csv_df):
+        self.csv_df = csv_df
+        self.columns = {field: csv_df[field].to_numpy(dtype=object) for field in MATCH_FIELDS if field in csv_df}
+        self.indexes = {}
+        self.hits = 0
+        self.fallback_hits = 0
+        self.misses = 0
+        self.get_index(('SeriesInstanceUID',))
+        self.get_index(FALLBACK_FIELDS)
+
+    def get_index(self, fields):
+        # built on first use for any other subset of fields present in a sidecar
+        if fields not in self.indexes:
+            index = {}
+            if not fields:
+                # a sidecar without any match field matches every row
+                index[()] = list(range(len(self.csv_df)))
+            elif all(field in self.columns for field in fields):
+                values = [self.columns[field] for field in fields]
+                for position, key in enumerate(zip(*values)):
+                    # rows with an empty match field can never compare equal
+                    if any(pd.isna(value) for value in key):
+                        continue
+                    index.setdefault(key, []).append(position)
+            self.indexes[fields] = index
+        return self.indexes[fields]
+
+    @timed('selection.csv_lookup')
+    def lookup(self, metadata):
+        present = [field for field in MATCH_FIELDS if field in metadata]
+        if 'SeriesInstanceUID' in present:
+            key_fields = ('SeriesInstanceUID',)
+        elif all(field in present for field in FALLBACK_FIELDS):
+            key_fields = FALLBACK_FIELDS
+        else:
+            key_fields = tuple(present)
+        try:
+            positions = self.get_index(key_fields).get(tuple(metadata[field] for field in key_fields), [])
+        except TypeError:
+            # unhashable sidecar value, cannot equal a CSV string
+            positions = []
+        rest = [field for field in present if field not in key_fields]
+        if any(field not in self.columns for field in rest):
+            positions = []
+        positions = [p for p in positions if all(self.columns[field][p] == metadata[field] for field in rest)]
+        if not positions:
+            self.misses += 1
+            count('selection.csv_misses')
+        elif key_fields == ('SeriesInstanceUID',):
+            self.hits += 1
+        else:
+            self.fallback_hits += 1
+        if positions:
+            count('selection.csv_matches')
+        return self.csv_df.iloc[positions]
+
+    def stats(self):
+        return {'hits': self.hits, 'fallback_hits': self.fallback_hits, 'misses': self.misses}
+
 
 class nii_selection:
-    def __init__(self, data_path, path_to_csv_file,pattern,dst_path):
+    def __init__(self, data_path, path_to_csv_file,pattern,dst_path,manifest=None,include=None,sidecars=None):
+        # path_to_csv_file may also be an already loaded marker table or a
+        # SeriesIndex shared between hospitals
         self.data_path = Path(data_path)
-        self.path_to_csv_file = Path(path_to_csv_file)
-        self.nii_files = self.get_files(pattern)
-        self.csv_file = self.get_csv_file()
+        self.manifest = manifest
+        # patient directories to process, None for all (a shard of a sharded run)
+        self.include = None if include is None else {Path(p_path) for p_path in include}
+        # SidecarIndex filled by the metadata stage of the same run, None to parse every sidecar
+        self.sidecars = sidecars
+        self.pattern = pattern
+        self.series_extensions = {}
+        self._nii_files = None
+        if isinstance(path_to_csv_file, SeriesIndex):
+            self.path_to_csv_file = None
+            self.csv_index = path_to_csv_file
+            self.csv_file = self.csv_index.csv_df
+        else:
+            self.path_to_csv_file = path_to_csv_file if isinstance(path_to_csv_file, pd.DataFrame) else Path(path_to_csv_file)
+            self.csv_file = self.get_csv_file()
+            self.csv_index = SeriesIndex(self.csv_file)
         self.dst_path = Path(dst_path) if dst_path else self.data_path
 
-    def get_files(self,pattern,):
-        files = {}
+    def iter_patients(self, pattern=None):
+        # lazy: each patient is yielded as soon as its own directory is listed
+        pattern = self.pattern if pattern is None else pattern
         # Check if the path exists and is a directory
         if not self.data_path.exists() or not self.data_path.is_dir():
-            return files
+            return
         # Iterate through hospital folders
-        for p_path in self.data_path.iterdir():
-            if p_path.is_dir():
+        for p_path in sorted(self.data_path.iterdir()):
+            if p_path.is_dir() and (self.include is None or p_path in self.include):
                 # Extract patient ID
                 p_match = re.match(pattern, p_path.name)
                 if p_match:
-                    p_id = p_match.group(0)
-                    if p_id not in files:
-                        files[p_id] = [p_path]
-                    # Iterate through files
-                    for file_path in p_path.rglob('*'):
-                        if file_path.is_file() and not file_path.name.startswith('._'):
-                            if file_path.name.endswith(".nii.gz") or file_path.name.endswith(".nii"):
-                                # For .nii.gz files, we need to remove both extensions
-                                if file_path.name.endswith(".nii.gz"):
-                                    file_path = str(file_path.parent/Path(file_path.name[:-7]))  # Remove .nii.gz
-                                else:
-                                    file_path = str(file_path.parent/Path(file_path.name[:-4]))  # Remove .nii
-                                files[p_id].append(file_path)
+                    yield p_match.group(0), p_path, scan_series(p_path)
+
+    def get_files(self,pattern,):
+        files = {}
+        for p_id, p_path, series in self.iter_patients(pattern):
+            if p_id not in files:
+                files[p_id] = [p_path]
+            files[p_id].extend(series)
+            self.series_extensions.update(series)
         return files
+
+    @property
+    def nii_files(self):
+        if self._nii_files is None:
+            self._nii_files = self.get_files(self.pattern)
+        return self._nii_files
     
     def get_csv_file(self):
+        if isinstance(self.path_to_csv_file, pd.DataFrame):
+            return as_marker_table(self.path_to_csv_file)
         csv_file = pd.read_csv(self.path_to_csv_file,dtype=str,encoding='utf-8-sig')
         return csv_file
     
@@ -52,27 +201,18 @@ class nii_selection:
         img = nib.load(Path(path))
         return img
     
+    @timed('selection.get_meta_data')
     def get_meta_data(self, path):
         if Path(path).name.startswith('._'): # Corrected typo here
             return None
-        encodings = ['utf-8', 'gbk', 'gb2312', 'gb18030', 'big5']
-        
-        for encoding in encodings:
-            try:
-                with open(path, 'r', encoding=encoding) as file:
-                    data = json.load(file)
-                return data
-            except UnicodeDecodeError:
-                continue
-            except json.JSONDecodeError:
-                continue
-            except Exception as e:
-                print(f"Error reading file {path} with {encoding} encoding: {e}")
-                continue
-                
-        # If none of the encodings worked
-        print(f"Failed to read JSON file {path} with any supported encoding")
-        return {}
+        data, encoding = load_sidecar(path, fields=SIDECAR_FIELDS, index=self.sidecars)
+        if data is None:
+            logger.warning('sidecar undecodable with any supported encoding', path=str(path))
+            return {}
+        count('selection.sidecars_parsed')
+        if is_fallback(encoding):
+            count('selection.decode_fallbacks')
+        return data
 
     def get_params_from_metadata(self,metadata,params):
         if params is str:
@@ -85,45 +225,92 @@ class nii_selection:
             return None
 
     
-    def find_matching_rows_in_csv(self, metadata, csv_df):
-        # Define fields to match
-        match_fields = ['SeriesDescription', 'ProtocolName', 'Manufacturer', 'SeriesInstanceUID']	
-
-        match_metadata = pd.DataFrame({field: metadata[field] for field in match_fields if field in metadata}, index=[0])
-        # Find matching rows
-        matching_rows = csv_df[csv_df.apply(lambda row: all(row[field] == metadata[field] for field in match_fields if field in metadata), axis=1)]
+    def find_matching_rows_in_csv(self, metadata, csv_df=None):
+        if csv_df is None or csv_df is self.csv_file:
+            return self.csv_index.lookup(metadata)
+        # Find matching rows on the fields present in the sidecar
+        matching_rows = csv_df[csv_df.apply(lambda row: all(row[field] == metadata[field] for field in MATCH_FIELDS if field in metadata), axis=1)]
         return matching_rows
 
 
-    def def_nii_file_with_type(self, marker='备注p'):
-        for i, pid in enumerate(self.nii_files.keys()):
-            print(f"\nProcessing patient: {pid}")
-            nii_files = self.nii_files[pid]
+    def def_nii_file_with_type(self, marker='备注p', link_mode='copy', workers=4, dry_run=False, dedup=None):
+        '''
+        copy (or link) every labelled series to the MAP-xxx-yyy layout; with
+        dry_run nothing is written and the source -> target plan is returned.
+        Without a deduplicator each series is submitted as soon as it is
+        scanned; with a SeriesDeduplicator the hospital's series are
+        fingerprinted before anything is written, duplicates and target name
+        collisions are reported in the plan and, in 'skip' mode, not exported
+        '''
+        plan = []
+        index_start = self.csv_index.stats()
+        moving = self.dst_path == self.data_path
+        queue = None if dry_run or moving else TransferQueue(link_mode=link_mode, workers=workers)
+
+        def export(candidate, status=None, original=None):
+            try:
+                skip = status is not None and dedup.mode == 'skip'
+                action = 'skip' if skip else ('move' if moving else link_mode)
+                plan.extend({'pid': candidate['pid'], 'label': candidate['label'], 'source': src, 'target': dst,
+                             'action': action, 'dedup': status or '', 'duplicate_of': original or ''}
+                            for src, dst in candidate['transfers'])
+                if dry_run or skip:
+                    return
+
+                os.makedirs(candidate['target_dir'], exist_ok=True)
+                if moving:
+                    # Move and rename files
+                    for src, dst in candidate['transfers']:
+                        shutil.move(src, dst)
+                    logger.debug('files moved', name=candidate['new_name'])
+                else:
+                    tag = (candidate['nii_path'], candidate['signature'], candidate['target'],
+                           candidate['parent_dir'], candidate['new_name'])
+                    self.transfer_done(queue.submit(candidate['transfers'], tag))
+
+            except Exception as e:
+                logger.error('error processing file', series=candidate['nii_path'], error=str(e))
+
+        # with a deduplicator the hospital's series are collected and checked
+        # before anything is written, otherwise each one is submitted as it is scanned
+        candidates = []
+        registered = []
+        for pid, parent_dir, series in self.iter_patients():
+            logger.debug('processing patient', pid=pid, series=len(series))
             csv_file = self.csv_file
-            print(f"Total number of NIfTI files: {len(nii_files)} ")
+            skipped = 0
 
-            for n in nii_files[1:]:
-                parent_dir = nii_files[0]
+            for n, extensions in series.items():
                 json_path = n + '.json'
                 nii_path = n + '.nii.gz'
-                bval_path = n + '.bval'
-                bvec_path = n + '.bvec'
                     
                 # Check if files exist
-                if not os.path.exists(json_path) or not os.path.exists(nii_path):
-                    print(f"Missing files - JSON: {json_path}, NII: {nii_path}")
+                if '.json' not in extensions or '.nii.gz' not in extensions:
+                    logger.warning('missing files', json=json_path, nii=nii_path)
                     continue
                 
+                # Skip series already exported from the same source files
+                incremental = self.manifest is not None and not moving
+                signature = None
+                if incremental:
+                    nii_size, nii_mtime = file_signature(nii_path)
+                    signature = (nii_size, max(nii_mtime, file_signature(json_path)[1]))
+                    if self.manifest.is_current('selection', nii_path, signature):
+                        skipped += 1
+                        if dedup is not None:
+                            registered.append((nii_path, self.manifest.get('selection', nii_path)['output']))
+                        continue
+                
                 # Get metadata
                 meta_data = self.get_meta_data(json_path)
                 if not meta_data:
-                    print("Failed to read metadata")
+                    logger.warning('failed to read metadata', json=json_path)
                     continue
                 
                 # Find matching rows
                 matching_rows = self.find_matching_rows_in_csv(meta_data, csv_file)
                 if matching_rows.empty:
-                    print(f"{n}:No matching rows found in CSV")
+                    logger.debug('no matching rows in CSV', series=n)
                     continue
                 
                 try:
@@ -133,10 +320,8 @@ class nii_selection:
                     series_number = meta_data['SeriesNumber']
                     series_description = meta_data['SeriesDescription']
                     
-                    print(f"Label: {label}")
-                    print(f"Series Number: {series_number}")
-                    print(f"Study Date: {study_date}")
-                    print(parent_dir)
+                    logger.debug('series labelled', label=label, series_number=series_number,
+                                 study_date=study_date, patient_dir=str(parent_dir))
 
                     hpid = int(self.data_path.name.split("+")[0])
                     p_num_id = int(pid.split("+")[0]) if pid.split("+")[0].isdigit() else int(pid.split("-")[2])
@@ -145,72 +330,126 @@ class nii_selection:
                     # new_name =  f"{series_number}_{series_description}_{label}"
                     new_name = f"{study_round}_{study_date}_{series_number}_{label}"
                     target_dir = os.path.join(self.dst_path, newid, study_round, label)
-                    os.makedirs(target_dir, exist_ok=True)
-                    
-                    # Move files
-                    # Move and rename files``
-                    if self.dst_path != self.data_path:
-                        if os.path.exists(nii_path) and os.path.exists(json_path):
-                            new_nii_path = os.path.join(target_dir, new_name + '.nii.gz')
-                            new_json_path = os.path.join(target_dir, new_name + '.json')
-                            new_bval_path = os.path.join(target_dir, new_name + '.bval')
-                            new_bvec_path = os.path.join(target_dir, new_name + '.bvec')
-                            
-                            if os.path.exists(bval_path):
-                                shutil.copy(bval_path, new_bval_path)
-                            if os.path.exists(bvec_path):
-                                shutil.copy(bvec_path, new_bvec_path)
-                            shutil.copy(nii_path, new_nii_path)
-                            shutil.copy(json_path, new_json_path)
-                            print(f"Files copyed and renamed successfully to {new_name}")
-                        else:
-                            print("Source files not found")
+
+                    # sources are known to exist from the directory scan
+                    transfers = [(n + extension, os.path.join(target_dir, new_name + extension))
+                                 for extension in ['.bval', '.bvec', '.nii.gz', '.json'] if extension in extensions]
+                    candidate = {'pid': pid, 'label': label, 'nii_path': nii_path, 'signature': signature,
+                                 'parent_dir': parent_dir, 'new_name': new_name, 'target_dir': target_dir,
+                                 'target': os.path.join(target_dir, new_name + '.nii.gz'), 'transfers': transfers}
+                    if dedup is None:
+                        export(candidate)
                     else:
-                        if os.path.exists(nii_path) and os.path.exists(json_path):
-                            new_nii_path = os.path.join(target_dir, new_name + '.nii.gz')
-                            new_json_path = os.path.join(target_dir, new_name + '.json')
-                            new_bval_path = os.path.join(target_dir, new_name + '.bval')
-                            new_bvec_path = os.path.join(target_dir, new_name + '.bvec')
-                            
-                            if os.path.exists(bval_path):
-                                shutil.move(bval_path, new_bval_path)
-                            if os.path.exists(bvec_path):
-                                shutil.move(bvec_path, new_bvec_path)
-                            shutil.move(nii_path, new_nii_path)
-                            shutil.move(json_path, new_json_path)
-                            print(f"Files moved and renamed successfully to {new_name}")
-                        else:
-                            print("Source files not found")
+                        candidates.append(candidate)
                         
                 except Exception as e:
-                    print(f"Error processing file: {e}")
+                    logger.error('error processing file', series=n, error=str(e))
                     continue
 
+            if skipped:
+                logger.info('unchanged series skipped', pid=pid, skipped=skipped)
+
+        # nothing has been written yet, duplicates and name collisions are known up front
+        if dedup is not None:
+            dedup.register(registered)
+            checks = dedup.check([(candidate['nii_path'], candidate['target']) for candidate in candidates])
+            for candidate, (status, original) in zip(candidates, checks):
+                export(candidate, status, original)
+
+        if queue is not None:
+            self.transfer_done(queue.close())
+            logger.info('transfers finished', hospital=self.data_path.name, bytes_copied=queue.bytes_copied)
+        if self.manifest is not None:
+            self.manifest.commit()
+        # the index may be shared between hospitals, log this hospital's share only
+        index_stats = self.csv_index.stats()
+        logger.info('csv index', hospital=self.data_path.name,
+                    **{key: value - index_start[key] for key, value in index_stats.items()})
+        return plan
+
+    def transfer_done(self, results):
+        for (nii_path, signature, new_nii_path, parent_dir, new_name), error in results:
+            if error is not None:
+                logger.error('error transferring series', name=new_name, error=str(error))
+                continue
+            if signature is not None:
+                self.manifest.record('selection', nii_path, signature, output=new_nii_path, grp=parent_dir)
+            logger.debug('files copied', name=new_name)
+
 
 if __name__ == "__main__":
     
     import argparse
+    import sharding
 
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--source_dir', type=str, help='input file path',required=True)
     parser.add_argument('--output_dir', type=str, help='output file path',required=True)
     parser.add_argument('--metadata', type=str, help='metadata notebook path',required=True)
     parser.add_argument('--pattern',default=r'^\d+\+\w+',help='file name pattern')
+    parser.add_argument('--full',action='store_true',help='ignore the manifest and export every series again')
+    parser.add_argument('--link_mode','--link-mode',default='copy',choices=LINK_MODES,help='how series are materialized in the output, falls back to copy')
+    parser.add_argument('--workers',type=int,default=4,help='number of concurrent file transfers')
+    parser.add_argument('--dry_run','--dry-run',action='store_true',help='only write the source -> target plan, do not touch the output')
+    parser.add_argument('--dedup',default='report',choices=DEDUP_MODES,help='fingerprint series before export and report or skip duplicates and target name collisions')
+    parser.add_argument('--hash_workers',type=int,default=8,help='number of threads hashing NIfTI files')
+    parser.add_argument('--hash_cache',type=str,default=None,help='sqlite cache of the series hashes (default hashes.sqlite next to the metadata table)')
+    parser.add_argument('--plan',type=str,default=None,help='plan CSV path for --dry_run (default OUTPUT_DIR/transfer_plan.csv)')
+    sharding.add_arguments(parser)
+    instrumentation.add_arguments(parser)
 
     args = parser.parse_args()
 
-    path_to_nii_folder = Path(args.source_dir)
-    path_to_csv_file = Path(args.metadata)
-    dst_path = Path(args.output_dir)
-    pattern=args.pattern
-    for hp_path in path_to_nii_folder.iterdir():
-        print(hp_path)
-        if hp_path.is_dir():
-            dst_path_new = dst_path/hp_path.name
-            if not dst_path_new.exists():
-                dst_path_new.mkdir(parents=True)
-            dataset = nii_selection(hp_path, path_to_csv_file, pattern,dst_path_new)
-            dataset.def_nii_file_with_type(marker='备注')
-
-
-    
\ No newline at end of file
+    with instrumentation.entry_point(args, 'selection') as logger:
+        path_to_nii_folder = Path(args.source_dir)
+        path_to_csv_file = Path(args.metadata)
+        dst_path = Path(args.output_dir)
+        pattern=args.pattern
+        manifest = None
+        include = None
+        suffix = ''
+        if args.shard is not None:
+            include, _, census_digest = sharding.select_shard(path_to_nii_folder, args.shard, balance=args.balance,
+                                                                census_path=args.census)
+            # concurrent shards write disjoint patients, each with its own manifest and plan
+            suffix = '.' + sharding.shard_name('selection', args.shard)
+        if not args.dry_run:
+            manifest = Manifest(dst_path / f'manifest{suffix}.sqlite')
+            # a new marker table can relabel series, so it invalidates every export
+            marker_signature = list(file_signature(path_to_csv_file))
+            if args.full or manifest.get_value('selection', 'marker_table') != marker_signature:
+                manifest.reset('selection')
+                manifest.set_value('selection', 'marker_table', marker_signature)
+        # one deduplicator for every hospital, so series referred between centers are found;
+        # its hashes have their own cache, kept by dry runs as well
+        dedup = None
+        if args.dedup != 'off':
+            hash_cache = Manifest(args.hash_cache or path_to_csv_file.parent / f'hashes{suffix}.sqlite')
+            dedup = SeriesDeduplicator(mode=args.dedup, workers=args.hash_workers, manifest=hash_cache)
+        # the marker table is loaded and indexed once for every hospital
+        csv_index = SeriesIndex(pd.read_csv(path_to_csv_file,dtype=str,encoding='utf-8-sig'))
+        plan = []
+        # sorted, so the first copy of a duplicated series is the same on every run
+        for hp_path in sorted(path_to_nii_folder.iterdir()):
+            logger.info('hospital', path=str(hp_path))
+            if hp_path.is_dir():
+                dst_path_new = dst_path/hp_path.name
+                if not args.dry_run and not dst_path_new.exists():
+                    dst_path_new.mkdir(parents=True)
+                dataset = nii_selection(hp_path, csv_index, pattern,dst_path_new,manifest=manifest,include=include)
+                plan.extend(dataset.def_nii_file_with_type(marker='备注', link_mode=args.link_mode,
+                                                           workers=args.workers, dry_run=args.dry_run, dedup=dedup))
+        if args.shard is not None:
+            # merged into transfer_plan.csv by python sharding.py selection
+            plan_path = dst_path / f'transfer_plan{suffix}.csv'
+            write_plan(plan, plan_path)
+            sharding.write_shard_file(dst_path, 'selection', args.shard, census_digest, path_to_nii_folder, include,
+                                      plan=plan_path.name, dedup=args.dedup)
+        elif args.dry_run:
+            plan_path = Path(args.plan) if args.plan else dst_path / 'transfer_plan.csv'
+            write_plan(plan, plan_path)
+            logger.info('dry run plan written', transfers=len(plan), path=str(plan_path))
+        if manifest is not None:
+            manifest.close()
+        if dedup is not None:
+            dedup.manifest.close()
@@ -0,0 +1,135 @@
+# End-to-end runner replacing selection_final.sh: metadata -> marker -> selection
+# with the tables passed in memory instead of through intermediate CSVs
+
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from MAP_series_marker import MAP_series_marker
+from metadata_sum import get_metadata, summarize_frames, write_summary
+from nii_selection import SIDECAR_FIELDS, SeriesIndex, as_marker_table, nii_selection
+from manifest import Manifest
+from series_dedup import DEDUP_MODES, HASH_CACHE, SeriesDeduplicator
+from series_transfer import write_plan
+from sidecar_io import DEFAULT_INDEX_SIZE, SidecarIndex
+import instrumentation
+
+logger = instrumentation.get_logger('pipeline')
+
+
+class Pipeline:
+    def __init__(self, source_dir, metadata_dir, output_dir, marker='备注', pattern=r'^\d+\+',
+                 split_char='+', selection_pattern=r'^\d+\+\w+', checkpoint_dir=None,
+                 sidecar_index=DEFAULT_INDEX_SIZE):
+        self.source_dir = Path(source_dir)
+        self.metadata_dir = Path(metadata_dir)
+        self.output_dir = Path(output_dir)
+        self.marker = marker
+        self.pattern = pattern
+        self.split_char = split_char
+        self.selection_pattern = selection_pattern
+        self.checkpoint_dir = Path(checkpoint_dir) if checkpoint_dir else None
+        self.timings = {}
+        # the sidecar fields the selection matches on, kept by the metadata stage
+        # for at most sidecar_index sidecars, the rest is parsed again
+        self.sidecars = SidecarIndex(SIDECAR_FIELDS, maxsize=sidecar_index)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        self.timings[name] = time.perf_counter() - start
+        logger.info('stage finished', stage=name, seconds=round(self.timings[name], 3))
+
+    def checkpoint(self, df, name):
+        if self.checkpoint_dir is not None:
+            self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+            df.to_csv(self.checkpoint_dir / name, index=False, encoding='utf-8-sig')
+
+    def run_metadata(self, workers=1, geometry=False):
+        with self.stage('metadata'):
+            frames = get_metadata(self.source_dir, self.metadata_dir, pattern=self.pattern,
+                                  split_char=self.split_char, workers=workers, collect=True, geometry=geometry,
+                                  index=self.sidecars)
+        with self.stage('summary'):
+            summary_df = summarize_frames(frames)
+            if self.checkpoint_dir is not None:
+                write_summary(summary_df, self.checkpoint_dir)
+        return summary_df
+
+    def run_marker(self, summary_df, round_window_days=180, label_cache=None):
+        with self.stage('marker'):
+            marker = MAP_series_marker(summary_df, marker=self.marker, round_window_days=round_window_days,
+                                       label_cache=label_cache)
+            marker_df = marker.map_series_rule()
+            self.checkpoint(marker_df, 'marker_metadata.csv')
+        return marker_df
+
+    def run_selection(self, marker_df, link_mode='copy', workers=4, dry_run=False, dedup='report'):
+        with self.stage('selection'):
+            # one marker table, one index and one deduplicator shared by every hospital
+            csv_index = SeriesIndex(as_marker_table(marker_df, marker=self.marker))
+            # hashes are cached next to the metadata CSVs, so repeat runs do not read unchanged series again
+            deduplicator = None
+            if dedup != 'off':
+                deduplicator = SeriesDeduplicator(mode=dedup, manifest=Manifest(self.metadata_dir / HASH_CACHE))
+            plan = []
+            for hp_path in sorted(self.source_dir.iterdir()):
+                if hp_path.is_dir():
+                    dst_path = self.output_dir / hp_path.name
+                    if not dry_run:
+                        dst_path.mkdir(parents=True, exist_ok=True)
+                    dataset = nii_selection(hp_path, csv_index, self.selection_pattern, dst_path, sidecars=self.sidecars)
+                    plan.extend(dataset.def_nii_file_with_type(marker=self.marker, link_mode=link_mode,
+                                                               workers=workers, dry_run=dry_run, dedup=deduplicator))
+            if deduplicator is not None:
+                deduplicator.manifest.close()
+            if dry_run or self.checkpoint_dir is not None:
+                write_plan(plan, (self.checkpoint_dir or self.output_dir) / 'transfer_plan.csv')
+        return plan
+
+    def run(self, workers=1, transfer_workers=4, link_mode='copy', dry_run=False, round_window_days=180,
+            label_cache=None, geometry=False, dedup='report'):
+        summary_df = self.run_metadata(workers=workers, geometry=geometry)
+        marker_df = self.run_marker(summary_df, round_window_days=round_window_days, label_cache=label_cache)
+        plan = self.run_selection(marker_df, link_mode=link_mode, workers=transfer_workers, dry_run=dry_run,
+                                  dedup=dedup)
+        logger.info('wall time per stage', **{name: round(seconds, 3) for name, seconds in self.timings.items()})
+        return plan
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from series_transfer import LINK_MODES
+
+    parser = argparse.ArgumentParser(description='Run metadata summary, series marking and NIfTI selection in one process.')
+    parser.add_argument('--source_dir', type=str, help='NIfTI dataset path', required=True)
+    parser.add_argument('--metadata_dir', type=str, help='per-patient metadata CSV path', required=True)
+    parser.add_argument('--output_dir', type=str, help='selection output path', required=True)
+    parser.add_argument('--marker', default='备注', help='marker column name')
+    parser.add_argument('--pattern', default=r'^\d+\+', help='patient directory pattern for metadata')
+    parser.add_argument('--split_char', default='+', help='file name split char')
+    parser.add_argument('--selection_pattern', default=r'^\d+\+\w+', help='patient directory pattern for selection')
+    parser.add_argument('--round_window', type=int, default=180, help='days covered by one study round')
+    parser.add_argument('--geometry', action='store_true', help='add NIfTI header geometry to the metadata')
+    parser.add_argument('--label_cache', type=str, default=None, help='JSON file keeping series labels between runs')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes reading patient directories')
+    parser.add_argument('--transfer_workers', type=int, default=4, help='number of concurrent file transfers')
+    parser.add_argument('--link_mode', '--link-mode', default='copy', choices=LINK_MODES, help='how series are materialized')
+    parser.add_argument('--dedup', default='report', choices=DEDUP_MODES, help='report or skip duplicate series and target name collisions')
+    parser.add_argument('--dry_run', '--dry-run', action='store_true', help='only write the transfer plan')
+    parser.add_argument('--sidecar_index', type=int, default=DEFAULT_INDEX_SIZE,
+                        help='sidecars whose selection fields are kept from the metadata stage, beyond that they are parsed again')
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help='also write every stage output here')
+    instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+
+    with instrumentation.entry_point(args, 'pipeline'):
+        pipeline = Pipeline(args.source_dir, args.metadata_dir, args.output_dir, marker=args.marker, pattern=args.pattern,
+                            split_char=args.split_char, selection_pattern=args.selection_pattern,
+                            checkpoint_dir=args.checkpoint_dir, sidecar_index=args.sidecar_index)
+        pipeline.run(workers=args.workers, transfer_workers=args.transfer_workers, link_mode=args.link_mode,
+                     dry_run=args.dry_run, round_window_days=args.round_window, label_cache=args.label_cache,
+                     geometry=args.geometry, dedup=args.dedup)
@@ -2,6 +2,8 @@ bash dcm2niix_MAP.sh
 python metadata_sum.py --source_dir /* --output_dir /*
 python MAP_series_marker.py --input /*.csv --output /*.csv --marker *
 python nii_selection.py --source_dir /* --output_dir /* --metadata /*.csv
+# the three steps above can also run in one process without intermediate CSVs:
+# python pipeline.py --source_dir /* --metadata_dir /* --output_dir /* --checkpoint_dir /*
 python metadata_sum.py --source_dir /* --output_dir /* --pattern '* - *' --split_char '-'
 python MAP_series_marker.py --input /*.csv --output /*.csv --marker *
 python study_sumup.py --input /*.csv --output /*.csv
\ No newline at end of file
@@ -0,0 +1,132 @@
+# Duplicate series detection before export
+#
+# A series is fingerprinted by the size of its NIfTI file and a hash of its
+# first and last chunk; only files whose fingerprints collide are hashed in
+# full. Hashes are cached under the 'hash' stage of a manifest of their own
+# (HASH_CACHE, next to the marker table), keyed on (size, mtime), so unchanged
+# files are never read twice across runs, dry runs included.
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+from instrumentation import count, timed
+from manifest import file_signature, source_key
+
+logger = instrumentation.get_logger('dedup')
+
+DEDUP_MODES = ['off', 'report', 'skip']
+CHUNK_SIZE = 1 << 20
+BLOCK_SIZE = 4 << 20
+HASH_CACHE = 'hashes.sqlite'
+
+
+def quick_fingerprint(path, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            digest.update(f.read(chunk_size))
+    return f'{size}:{digest.hexdigest()}'
+
+
+def full_hash(path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SeriesDeduplicator:
+    '''
+    remembers every series accepted for export (across hospitals when shared)
+    and classifies new ones as duplicates of an accepted series or as target
+    name collisions
+    '''
+    def __init__(self, mode='report', workers=8, manifest=None):
+        self.mode = mode
+        self.workers = workers
+        self.manifest = manifest
+        self.quick = {}
+        self.full = {}
+        self.accepted = {}
+        self.targets = {}
+
+    def _cached(self, paths, kind, func):
+        known = self.quick if kind == 'quick' else self.full
+        signatures = {}
+        missing = []
+        for path in paths:
+            if path in known:
+                continue
+            signatures[path] = file_signature(path)
+            entry = self.manifest.get('hash', path) if self.manifest is not None else None
+            if entry is not None and (entry['size'], entry['mtime_ns']) == signatures[path] and kind in entry['info']:
+                known[path] = entry['info'][kind]
+            else:
+                missing.append(path)
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for path, value in zip(missing, executor.map(func, missing)):
+                    known[path] = value
+            count(f'dedup.{kind}_hashed', len(missing))
+            if self.manifest is not None:
+                for path in missing:
+                    info = {'quick': self.quick.get(path)}
+                    if path in self.full:
+                        info['full'] = self.full[path]
+                    self.manifest.record('hash', path, signatures[path], info=info)
+                self.manifest.commit()
+
+    @timed('dedup.fingerprint')
+    def fingerprint(self, paths):
+        self._cached(paths, 'quick', quick_fingerprint)
+        quick_counts = {}
+        for path in paths:
+            quick_counts[self.quick[path]] = quick_counts.get(self.quick[path], 0) + 1
+        # full hashes only where the cheap fingerprint is not unique
+        colliding = [path for path in paths
+                     if quick_counts[self.quick[path]] > 1 or self.quick[path] in self.accepted]
+        for path in colliding:
+            colliding.extend(kept for kept in self.accepted.get(self.quick[path], []) if kept not in colliding)
+        self._cached(colliding, 'full', full_hash)
+
+    def register(self, series):
+        # (nii_path, target) of series exported by earlier runs, kept as the
+        # originals; fingerprinted in one batch like check()
+        self.fingerprint([nii_path for nii_path, _ in series])
+        for nii_path, target in series:
+            self.accepted.setdefault(self.quick[nii_path], []).append(nii_path)
+            self.targets[source_key(target)] = nii_path
+
+    def check(self, series):
+        '''
+        series is a list of (nii_path, target); returns (status, original) for
+        each, status None, 'duplicate' or 'collision', in order so the first
+        copy of a series wins
+        '''
+        self.fingerprint([nii_path for nii_path, _ in series])
+        results = []
+        for nii_path, target in series:
+            # absolute, the targets of earlier runs come from the manifest
+            target = source_key(target)
+            group = self.accepted.setdefault(self.quick[nii_path], [])
+            original = next((kept for kept in group
+                             if kept != nii_path and self.full.get(kept) == self.full.get(nii_path)), None)
+            if original is not None:
+                count('dedup.duplicates')
+                logger.warning('duplicate series', source=nii_path, original=original)
+                results.append(('duplicate', original))
+            elif self.targets.get(target, nii_path) != nii_path:
+                count('dedup.collisions')
+                logger.warning('target name collision', source=nii_path, target=target, taken_by=self.targets[target])
+                results.append(('collision', self.targets[target]))
+            else:
+                group.append(nii_path)
+                self.targets[target] = nii_path
+                results.append((None, None))
+        return results
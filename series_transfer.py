@@ -0,0 +1,124 @@
+import csv
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+
+from instrumentation import count, timed
+
+LINK_MODES = ['copy', 'hardlink', 'symlink', 'reflink']
+PLAN_COLUMNS = ['pid', 'label', 'source', 'target', 'action', 'dedup', 'duplicate_of']
+
+# linux ioctl asking the filesystem (btrfs, xfs, ...) to share the source extents
+FICLONE = 0x40049409
+
+
+def reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copymode(src, dst)
+
+
+def materialize(src, dst, link_mode='copy'):
+    '''
+    place src at dst using link_mode, falling back to a plain copy when the
+    link cannot be made (other device, unsupported filesystem, ...);
+    returns the mode actually used
+    '''
+    # built under a private name and renamed over dst: a link an earlier run
+    # (or another transfer) left at dst is replaced, never written through
+    tmp = os.path.join(os.path.dirname(dst), f'.{os.path.basename(dst)}.{os.getpid()}.{threading.get_ident()}.tmp')
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    mode = 'copy'
+    if link_mode != 'copy':
+        try:
+            if link_mode == 'hardlink':
+                os.link(src, tmp)
+            elif link_mode == 'symlink':
+                os.symlink(os.path.abspath(src), tmp)
+            elif link_mode == 'reflink':
+                reflink(src, tmp)
+            else:
+                raise ValueError(f'Unknown link mode {link_mode}')
+            mode = link_mode
+        except (OSError, ImportError):
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+    if mode == 'copy':
+        shutil.copy(src, tmp)
+    os.replace(tmp, dst)
+    return mode
+
+
+@timed('selection.materialize_series')
+def materialize_series(transfers, link_mode='copy'):
+    copied = 0
+    for src, dst in transfers:
+        if materialize(src, dst, link_mode) == 'copy':
+            copied += os.path.getsize(dst)
+    return copied
+
+
+class TransferQueue:
+    '''
+    thread pool materializing whole series (a list of (src, dst) pairs);
+    completions are handed back to the submitting thread by submit/close.
+    Series writing to a target still being written wait for that transfer,
+    so the last one submitted wins as in a sequential run
+    '''
+    def __init__(self, link_mode='copy', workers=4, max_pending=None):
+        self.link_mode = link_mode
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending or workers * 4
+        self.pending = {}
+        self.targets = {}
+        self.bytes_copied = 0
+
+    def _finished(self, futures):
+        results = []
+        for future in futures:
+            tag, targets = self.pending.pop(future)
+            for dst in targets:
+                if self.targets.get(dst) is future:
+                    del self.targets[dst]
+            error = future.exception()
+            if error is None:
+                self.bytes_copied += future.result()
+                count('selection.bytes_copied', future.result())
+                count('selection.series_transferred')
+            results.append((tag, error))
+        return results
+
+    def submit(self, transfers, tag=None):
+        # blocks while the queue is full, returns the series finished meanwhile
+        results = []
+        conflicts = {self.targets[dst] for _, dst in transfers if dst in self.targets}
+        if conflicts:
+            wait(conflicts)
+            results.extend(self._finished(conflicts))
+        if len(self.pending) >= self.max_pending:
+            done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+            results.extend(self._finished(done))
+        future = self.executor.submit(materialize_series, transfers, self.link_mode)
+        targets = [dst for _, dst in transfers]
+        self.pending[future] = (tag, targets)
+        for dst in targets:
+            self.targets[dst] = future
+        return results
+
+    def close(self):
+        results = self._finished(list(self.pending))
+        self.executor.shutdown()
+        return results
+
+
+def write_plan(plan, plan_path):
+    plan_path = Path(plan_path)
+    plan_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(plan_path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=PLAN_COLUMNS)
+        writer.writeheader()
+        writer.writerows(plan)
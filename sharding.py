@@ -0,0 +1,280 @@
+# Splitting the center/patient tree across nodes (--shard i/N) and merging
+# the partial outputs back into what a single-node run writes
+#
+# Every shard lists the patient directories, weighs them by file count (the
+# census, names only, nothing is stat'ed) and runs the same greedy
+# largest-first assignment, so all nodes agree on the split without talking to
+# each other. "python sharding.py census" writes the census to a file once and
+# --census FILE hands every shard the same numbers. A shard writes
+# {stage}_shard_{i}_of_{N}.json next to its outputs; the merge checks that all
+# N are there and made the same split.
+
+import argparse
+import csv
+import hashlib
+import heapq
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import instrumentation
+
+logger = instrumentation.get_logger('sharding')
+
+BALANCE_MODES = ['size', 'hash']
+
+
+def parse_shard(text):
+    # 'i/N' with 0 <= i < N
+    try:
+        index, shards = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must look like i/N, got {text!r}')
+    if shards < 1 or not 0 <= index < shards:
+        raise argparse.ArgumentTypeError(f'shard index must be in 0..N-1, got {text!r}')
+    return index, shards
+
+
+def add_arguments(parser):
+    parser.add_argument('--shard', type=parse_shard, default=None, help='only process shard i of N (0-based, e.g. 0/4)')
+    parser.add_argument('--balance', default='size', choices=BALANCE_MODES,
+                        help='assign patients by census file count (greedy largest first) or by hash alone')
+    parser.add_argument('--census', type=str, default=None,
+                        help='census JSON written by python sharding.py census, instead of counting files on every shard')
+
+
+def directory_size(path):
+    total = 0
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def file_count(path):
+    # directory entries carry their type, so counting needs no stat call
+    total = 0
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += 1
+    return total
+
+
+def stable_hash(name):
+    # hash() is salted per process, md5 gives every node the same number
+    return int(hashlib.md5(name.encode('utf-8')).hexdigest(), 16)
+
+
+def list_patients(source_dir):
+    units = []
+    for center in sorted(Path(source_dir).iterdir()):
+        if center.is_dir():
+            units.extend(patient for patient in sorted(center.iterdir()) if patient.is_dir())
+    return units
+
+
+def census(units, workers=8):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(units, executor.map(file_count, units)))
+
+
+def write_census(source_dir, path, workers=8):
+    source_dir = Path(source_dir)
+    counts = census(list_patients(source_dir), workers)
+    entry = {'source_dir': str(source_dir),
+             'units': {unit.relative_to(source_dir).as_posix(): files for unit, files in sorted(counts.items())}}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, ensure_ascii=False, indent=1)
+    logger.info('census written', patients=len(counts), files=sum(counts.values()), path=str(path))
+    return path
+
+
+def read_census(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)['units']
+
+
+def assign_shards(sizes, shards, balance='size'):
+    '''
+    map every unit name to a shard; 'size' is greedy longest-processing-time
+    (largest unit to the least loaded shard, hash as tie-break), 'hash' ignores sizes
+    '''
+    if balance == 'hash':
+        return {name: stable_hash(name) % shards for name in sizes}
+    loads = [(0, shard) for shard in range(shards)]
+    assignment = {}
+    for name in sorted(sizes, key=lambda name: (-sizes[name], stable_hash(name), name)):
+        load, shard = heapq.heappop(loads)
+        assignment[name] = shard
+        heapq.heappush(loads, (load + sizes[name], shard))
+    return assignment
+
+
+def select_shard(source_dir, shard, units=None, balance='size', workers=8, census_path=None):
+    '''
+    the patient directories (center/patient under source_dir) of one shard,
+    their census weights and a digest of the whole split; census_path reads
+    the weights from a census file (patients missing from it weigh 0)
+    '''
+    source_dir = Path(source_dir)
+    units = list_patients(source_dir) if units is None else units
+    names = {unit.relative_to(source_dir).as_posix(): unit for unit in units}
+    if balance != 'size':
+        named_sizes = {name: 0 for name in names}
+    elif census_path is not None:
+        counts = read_census(census_path)
+        named_sizes = {name: counts.get(name, 0) for name in names}
+    else:
+        counts = census(units, workers)
+        named_sizes = {name: counts[unit] for name, unit in names.items()}
+    assignment = assign_shards(named_sizes, shard[1], balance)
+    # the split, not the weights: shards agree as long as they assign alike
+    digest = hashlib.sha1(json.dumps(sorted(assignment.items())).encode('utf-8')).hexdigest()
+    selected = [unit for name, unit in names.items() if assignment[name] == shard[0]]
+    sizes = {unit: named_sizes[name] for name, unit in names.items()}
+    logger.info('shard selected', shard=f'{shard[0]}/{shard[1]}', patients=len(selected), of_patients=len(units),
+                files=sum(sizes[unit] for unit in selected), total_files=sum(sizes.values()))
+    return selected, {unit: sizes[unit] for unit in selected}, digest
+
+
+def shard_name(stage, shard):
+    return f'{stage}_shard_{shard[0]}_of_{shard[1]}'
+
+
+def write_shard_file(output_dir, stage, shard, census_digest, source_dir, units, **info):
+    entry = {'stage': stage, 'shard': shard[0], 'shards': shard[1], 'census': census_digest,
+             'source_dir': str(source_dir), 'units': sorted(Path(unit).relative_to(source_dir).as_posix() for unit in units)}
+    entry.update(info)
+    path = Path(output_dir) / f'{shard_name(stage, shard)}.json'
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, ensure_ascii=False, indent=1)
+    return path
+
+
+def read_shard_files(output_dir, stage, shards):
+    entries = []
+    for index in range(shards):
+        path = Path(output_dir) / f'{shard_name(stage, (index, shards))}.json'
+        if not path.exists():
+            raise FileNotFoundError(f'shard {index}/{shards} has not finished: {path} is missing')
+        with open(path, 'r', encoding='utf-8') as f:
+            entries.append(json.load(f))
+    if len({entry['census'] for entry in entries}) > 1:
+        raise ValueError(f'{stage} shards split the patients differently, the tree changed between runs (use --census)')
+    units = [unit for entry in entries for unit in entry['units']]
+    if len(units) != len(set(units)):
+        raise ValueError(f'{stage} shards overlap')
+    return entries
+
+
+def merge_metadata(output_dir, shards, pattern=r'^\d+\+', formats=('csv',)):
+    '''
+    summary of the per-patient CSVs listed by every shard, the same table a
+    single-node sum_metadata writes
+    '''
+    from metadata_sum import sum_metadata
+
+    output_dir = Path(output_dir)
+    entries = read_shard_files(output_dir, 'metadata', shards)
+    files = [output_dir / name for entry in entries for name in entry['outputs']]
+    return sum_metadata(output_dir, pattern=pattern, formats=formats, files=files)
+
+
+def plan_order(source_dir):
+    # single-node order: hospitals, then patients, sorted; series stay in scan order
+    def key(row):
+        parts = Path(row['source']).relative_to(source_dir).parts
+        return parts[:2]
+    return key
+
+
+def series_stem(path):
+    return path[:-len('.nii.gz')] if path.endswith('.nii.gz') else os.path.splitext(path)[0]
+
+
+def mark_duplicates(plan, skip=False, workers=8):
+    '''
+    redo the duplicate and name collision check over the merged plan: a shard
+    only saw its own patients, a single-node run sees them all in this order.
+    With skip (the shards ran with --dedup skip) the rows found are skipped
+    '''
+    from series_dedup import SeriesDeduplicator
+
+    series = [(row['source'], row['target']) for row in plan if row['source'].endswith('.nii.gz')]
+    checks = dict(zip((source for source, _ in series), SeriesDeduplicator(workers=workers).check(series)))
+    for row in plan:
+        status, original = checks.get(series_stem(row['source']) + '.nii.gz', (None, None))
+        row['dedup'] = status or ''
+        row['duplicate_of'] = original or ''
+        if status is not None and skip:
+            row['action'] = 'skip'
+
+
+def merge_plans(output_dir, shards, plan_path=None, workers=8):
+    from series_transfer import PLAN_COLUMNS, write_plan
+
+    output_dir = Path(output_dir)
+    entries = read_shard_files(output_dir, 'selection', shards)
+    plan = []
+    for entry in entries:
+        with open(output_dir / entry['plan'], 'r', newline='', encoding='utf-8-sig') as f:
+            plan.extend({column: row.get(column, '') for column in PLAN_COLUMNS} for row in csv.DictReader(f))
+    # sort is stable, so each patient's rows keep the order its shard wrote them in
+    plan.sort(key=plan_order(Path(entries[0]['source_dir'])))
+    modes = {entry.get('dedup', 'off') for entry in entries}
+    if len(modes) > 1:
+        raise ValueError(f'selection shards ran with different --dedup modes: {", ".join(sorted(modes))}')
+    if modes != {'off'}:
+        # the plan is right, the export is not: shards that did not run dry
+        # have written the duplicates they could not see from their own patients
+        mark_duplicates(plan, skip=modes == {'skip'}, workers=workers)
+    plan_path = Path(plan_path) if plan_path else output_dir / 'transfer_plan.csv'
+    write_plan(plan, plan_path)
+    logger.info('plans merged', shards=shards, transfers=len(plan), path=str(plan_path))
+    return plan
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write the census of a sharded run or merge its partial outputs.')
+    parser.add_argument('command', choices=['census', 'metadata', 'selection'],
+                        help='write the census or which stage to merge; the merged selection plan marks duplicates '
+                             'across shards like a single-node run, but exporting shards only checked their own patients '
+                             'and have written them (run the shards with --dry_run to review them first)')
+    parser.add_argument('--source_dir', type=str, help='center/patient tree to count (census)')
+    parser.add_argument('--census', type=str, help='census JSON path to write (census)')
+    parser.add_argument('--workers', type=int, default=8, help='threads counting patient directories (census)')
+    parser.add_argument('--output_dir', type=str, help='output path the shards wrote to (metadata, selection)')
+    parser.add_argument('--shards', type=int, help='number of shards N (metadata, selection)')
+    parser.add_argument('--pattern', default=r'^\d+\+', help='per-patient CSV name pattern (metadata)')
+    parser.add_argument('--formats', nargs='+', default=['csv'], choices=['csv', 'parquet', 'feather'], help='summary output formats (metadata)')
+    parser.add_argument('--plan', type=str, default=None, help='merged plan path (selection, default OUTPUT_DIR/transfer_plan.csv)')
+    parser.add_argument('--hash_workers', type=int, default=8, help='threads fingerprinting series for the merged duplicate check (selection)')
+    instrumentation.add_arguments(parser)
+
+    args = parser.parse_args()
+    required = ['source_dir', 'census'] if args.command == 'census' else ['output_dir', 'shards']
+    missing = [f'--{name}' for name in required if getattr(args, name) is None]
+    if missing:
+        parser.error(f'{args.command} needs {" and ".join(missing)}')
+
+    with instrumentation.entry_point(args, 'sharding'):
+        try:
+            if args.command == 'census':
+                write_census(args.source_dir, args.census, workers=args.workers)
+            elif args.command == 'metadata':
+                merge_metadata(args.output_dir, args.shards, pattern=args.pattern, formats=args.formats)
+            else:
+                merge_plans(args.output_dir, args.shards, plan_path=args.plan, workers=args.hash_workers)
+        except (FileNotFoundError, ValueError) as e:
+            raise SystemExit(str(e))
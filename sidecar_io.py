@@ -0,0 +1,120 @@
+# Shared reader for the dcm2niix JSON sidecars
+#
+# A sidecar is read once as bytes and decoded in memory, UTF-8 first and then
+# the Chinese codecs the scanners export with. The metadata stage can keep the
+# few fields the selection matches on in a SidecarIndex keyed on path, size and
+# mtime (pool workers return theirs to the parent), so a pipeline run parses
+# each sidecar once whatever the number of workers. The index is bounded: past
+# maxsize the oldest entries are dropped and the selection parses those again.
+
+import json
+import os
+from collections import OrderedDict
+
+from instrumentation import count
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# utf-8-sig also reads plain UTF-8 and drops the BOM some exporters write
+ENCODINGS = ['utf-8-sig', 'gbk', 'gb2312', 'gb18030', 'big5']
+DEFAULT_INDEX_SIZE = 262144
+
+
+class SidecarIndex:
+    '''
+    the given fields of the sidecars parsed by one stage until the next one
+    takes them, at most maxsize of them (oldest dropped first); entries maps
+    (path, size, mtime_ns) to (fields, encoding)
+    '''
+    def __init__(self, fields, maxsize=DEFAULT_INDEX_SIZE):
+        self.fields = list(fields)
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def add(self, key, data, encoding):
+        self.entries[key] = ({field: data[field] for field in self.fields if field in data}, encoding)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            count('sidecar.index_evicted')
+
+    def take(self, key, fields):
+        # every sidecar is read once per stage, so a hit leaves the index
+        if not set(fields) <= set(self.fields):
+            return None
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        data, encoding = entry
+        return {field: data[field] for field in fields if field in data}, encoding
+
+    def update(self, entries):
+        for key, (data, encoding) in entries.items():
+            self.add(key, data, encoding)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def sidecar_key(path):
+    path = os.path.abspath(os.fspath(path))
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime_ns
+
+
+def parse_sidecar(raw):
+    '''
+    decode and parse the bytes of a sidecar, return (dict, encoding) or
+    (None, None) when no encoding gives valid JSON
+    '''
+    if orjson is not None:
+        try:
+            return orjson.loads(raw), 'utf-8'
+        except orjson.JSONDecodeError:
+            # BOM, NaN, huge integers or a non UTF-8 file: take the slow path
+            pass
+    for encoding in ENCODINGS:
+        try:
+            return json.loads(raw.decode(encoding)), encoding
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            continue
+    return None, None
+
+
+def load_sidecar(path, fields=None, index=None):
+    '''
+    return (data, encoding) for a sidecar, data holding only the given fields
+    when fields is set; data is None when the file cannot be read or decoded.
+    An index filled by an earlier stage answers for the files it holds
+    when fields is set, one given without fields records the ones parsed here
+    '''
+    try:
+        key = sidecar_key(path)
+    except OSError:
+        return None, None
+    if index is not None and fields is not None:
+        entry = index.take(key, fields)
+        if entry is not None:
+            count('sidecar.index_hits')
+            return entry
+    try:
+        with open(key[0], 'rb') as f:
+            raw = f.read()
+    except OSError:
+        return None, None
+    data, encoding = parse_sidecar(raw)
+    count('sidecar.parsed')
+    if not isinstance(data, dict):
+        return None, None
+    if index is not None and fields is None:
+        index.add(key, data, encoding)
+    if fields is None:
+        return data, encoding
+    return {field: data[field] for field in fields if field in data}, encoding
+
+
+def is_fallback(encoding):
+    return encoding not in ('utf-8', 'utf-8-sig')
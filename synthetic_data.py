@@ -0,0 +1,154 @@
+# Synthetic multicenter dataset in the dcm2niix output layout, for benchmarks
+# and smoke runs without patient data
+#   CenterID+Name/PatientID+Name/StudyDate/{series}+{protocol}+{time}.json|.nii.gz|.bval|.bvec
+
+import gzip
+import json
+import random
+import struct
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from MAP_series_marker import MAP_series_marker
+
+MANUFACTURERS = [('SIEMENS', 0.4), ('GE', 0.25), ('Philips', 0.2), ('TOSHIBA_MEC', 0.1), ('UIH', 0.05)]
+# rough share of each sequence type in a clinical brain protocol
+SEQUENCE_WEIGHTS = {'T2': 6, 'T2Flair': 5, 'T1': 6, 'DWI': 4, 'ADC': 3, 'TOF': 2, 'ASL': 1, 'DTI': 1,
+                    'SWI': 3, 'QSM': 1, 'Plaque': 1, 'bold': 1}
+OTHERS_WEIGHT = 3
+DELETE_WEIGHT = 2
+DIFFUSION_TYPES = {'DWI', 'DTI'}
+
+
+def pattern_choices(pattern):
+    # the literal alternatives of a rule pattern are realistic descriptions
+    return [choice for choice in pattern.split('|') if choice]
+
+
+def description_pool():
+    marker = MAP_series_marker(pd.DataFrame())
+    pool = [(sequence_type, pattern_choices(pattern), SEQUENCE_WEIGHTS.get(sequence_type, 1))
+            for sequence_type, pattern in marker.sequence_patterns.items()]
+    pool.append(('Others', pattern_choices(marker.others_pattern), OTHERS_WEIGHT))
+    pool.append(('delete', pattern_choices(marker.delete_pattern), DELETE_WEIGHT))
+    return pool
+
+
+def nifti_bytes(shape, pixdim):
+    # minimal NIfTI-1 single file: 348 byte header, 4 byte extension flag, uint8 voxels
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, *dim)
+    struct.pack_into('<hh', header, 70, 2, 8)
+    struct.pack_into('<8f', header, 76, 1.0, *pixdim, *([1.0] * (7 - len(pixdim))))
+    struct.pack_into('<f', header, 108, 352.0)
+    struct.pack_into('<f', header, 112, 1.0)
+    struct.pack_into('<B', header, 123, 10)
+    header[344:348] = b'n+1\x00'
+    voxels = 1
+    for size in shape:
+        voxels *= size
+    return bytes(header) + b'\x00' * 4 + bytes(voxels)
+
+
+def make_series(rng, pool, manufacturer):
+    sequence_type, choices, _ = rng.choices(pool, weights=[weight for _, _, weight in pool])[0]
+    description = rng.choice(choices)
+    if manufacturer == 'TOSHIBA_MEC' and rng.random() < 0.3:
+        # Toshiba exports often only carry the sequence in ProtocolName
+        return sequence_type, 'ORIGINAL', rng.choice(['T2 TSE', 'T1 SE', 'Flair'])
+    protocol = description if rng.random() < 0.7 else description.replace(' ', '_').lower()
+    return sequence_type, description, protocol
+
+
+def write_series(study_dir, stem, sidecar, shape, pixdim, diffusion, encoding):
+    with open(study_dir / f'{stem}.json', 'wb') as f:
+        f.write(json.dumps(sidecar, ensure_ascii=False, indent=1).encode(encoding))
+    with gzip.open(study_dir / f'{stem}.nii.gz', 'wb', compresslevel=1) as f:
+        f.write(nifti_bytes(shape, pixdim))
+    if diffusion:
+        (study_dir / f'{stem}.bval').write_text('0 1000 1000 1000\n')
+        (study_dir / f'{stem}.bvec').write_text('0 1 0 0\n0 0 1 0\n0 0 0 1\n')
+
+
+def generate_dataset(root, n_series=1000, centers=5, series_per_patient=12, seed=0,
+                     gbk_fraction=0.1, appledouble_fraction=0.05):
+    '''
+    write a fake center/patient tree with about n_series dcm2niix series and
+    return the number of series written
+    '''
+    rng = random.Random(seed)
+    root = Path(root)
+    pool = description_pool()
+    n_patients = max(1, n_series // series_per_patient)
+    written = 0
+    for patient in range(n_patients):
+        center = patient % centers + 1
+        center_dir = root / f'{center}+Center{center}'
+        manufacturer = rng.choices([m for m, _ in MANUFACTURERS], weights=[w for _, w in MANUFACTURERS])[0]
+        first_visit = datetime(2018, 1, 1) + timedelta(days=rng.randint(0, 1500))
+        visits = [first_visit + timedelta(days=rng.choice([0, 90, 200, 400]) * i) for i in range(rng.randint(1, 3))]
+        patient_dir = center_dir / f'{patient + 1}+Patient{patient + 1}'
+        for series_number in range(1, series_per_patient + 1):
+            if written >= n_series:
+                break
+            visit = visits[series_number % len(visits)]
+            study_dir = patient_dir / visit.strftime('%Y%m%d')
+            study_dir.mkdir(parents=True, exist_ok=True)
+            sequence_type, description, protocol = make_series(rng, pool, manufacturer)
+            three_d = sequence_type in ('T1', 'TOF', 'SWI') and rng.random() < 0.5
+            spacing = round(rng.uniform(0.5, 1.2), 2) if three_d else round(rng.uniform(3, 6.5), 1)
+            slices = 8 if three_d else 4
+            acquired = visit + timedelta(minutes=series_number * 3)
+            sidecar = {
+                'Modality': 'MR',
+                'Manufacturer': manufacturer,
+                'SeriesDescription': description,
+                'ProtocolName': protocol,
+                'SeriesInstanceUID': f'1.2.826.0.1.{seed}.{patient}.{series_number}.{visit:%Y%m%d}',
+                'SeriesNumber': series_number,
+                'AcquisitionDateTime': acquired.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+                'SliceThickness': spacing,
+                'EchoTime': round(rng.uniform(0.002, 0.12), 4),
+                'RepetitionTime': round(rng.uniform(0.005, 9), 3),
+                'MagneticFieldStrength': rng.choice([1.5, 3]),
+                'ConversionSoftware': 'dcm2niix',
+            }
+            # dcm2niix drops SpacingBetweenSlices for many 2D series
+            if rng.random() < 0.7:
+                sidecar['SpacingBetweenSlices'] = spacing
+            if rng.random() < 0.2:
+                sidecar['ImageComments'] = 'synthetic'
+            encoding = 'utf-8'
+            if rng.random() < gbk_fraction:
+                sidecar['InstitutionName'] = f'第{center}医院'
+                encoding = 'gbk'
+            stem = f'{series_number}+{protocol.replace(" ", "_").replace("/", "_")}+{acquired:%H%M%S}'
+            pixdim = [1.0, 1.0, spacing]
+            write_series(study_dir, stem, sidecar, (4, 4, slices), pixdim,
+                         sequence_type in DIFFUSION_TYPES, encoding)
+            if rng.random() < appledouble_fraction:
+                # macOS AppleDouble junk next to the real sidecar
+                (study_dir / f'._{stem}.json').write_bytes(b'\x00\x05\x16\x07' + bytes(rng.getrandbits(8) for _ in range(28)))
+            written += 1
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic multicenter dcm2niix dataset.')
+    parser.add_argument('--output_dir', type=str, help='dataset root', required=True)
+    parser.add_argument('--series', type=int, default=1000, help='number of series')
+    parser.add_argument('--centers', type=int, default=5, help='number of centers')
+    parser.add_argument('--series_per_patient', type=int, default=12, help='series per patient')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+    args = parser.parse_args()
+
+    written = generate_dataset(args.output_dir, n_series=args.series, centers=args.centers,
+                               series_per_patient=args.series_per_patient, seed=args.seed)
+    print(f'Wrote {written} series to {args.output_dir}')
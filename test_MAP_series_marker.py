@@ -0,0 +1,77 @@
+# Parity of the vectorized rule engine with the original row loop
+
+import numpy as np
+import pandas as pd
+
+from MAP_series_marker import MAP_series_marker
+
+
+def marker_table():
+    rows = [
+        # SeriesDescription, ProtocolName, Manufacturer, SpacingBetweenSlices
+        ('t2_tse_tra', 't2_tse_tra', 'SIEMENS', 5.0),
+        ('T2_FLAIR_tra', 'T2_FLAIR_tra', 'Philips', 5.0),
+        ('Ax T1 FLAIR', 'Ax T1 FLAIR', 'GE', 5.0),
+        # later sequence patterns win over earlier ones (DWI after T2)
+        ('T2 DWI', 'T2 DWI', 'GE', 5.0),
+        # NaN description falls back to ProtocolName
+        (np.nan, 'ADC map', 'SIEMENS', 5.0),
+        (np.nan, 'loc_scout', 'SIEMENS', np.nan),
+        (np.nan, np.nan, 'SIEMENS', np.nan),
+        # Others: pattern, 'loc' in the protocol, five capitals, A / 2 / HF
+        ('Screen Save', 'Screen Save', 'SIEMENS', np.nan),
+        ('T1 axial', 'localizer', 'SIEMENS', np.nan),
+        ('ABCDE', 'x', 'GE', np.nan),
+        ('ABCDEF', 'x', 'GE', np.nan),
+        ('A', 'x', 'GE', np.nan),
+        ('2', 'x', 'GE', np.nan),
+        ('HF', 'x', 'GE', np.nan),
+        # delete beats Others and the sequence types
+        ('T2 STIR', 'T2 STIR', 'SIEMENS', 5.0),
+        ('Scout', 'Protocol', 'SIEMENS', np.nan),
+        ('T1', 'T1', 'jpg export', np.nan),
+        # Toshiba series labelled from ProtocolName only
+        ('ORIGINAL', 'T2 TSE', 'TOSHIBA_MEC', 5.0),
+        ('ORIGINAL', 'Flair T2', 'TOSHIBA_MEC', 5.0),
+        ('ORIGINAL', 'T1 SE', 'TOSHIBA_MEC', 5.0),
+        ('T2 tra', 'T1 SE', 'TOSHIBA_MEC', 5.0),
+        ('ORIGINAL', 'misc', 'TOSHIBA_MEC', 5.0),
+        # SWI phase images
+        ('SWI_Pha_Images', 'SWI', 'SIEMENS', 2.0),
+        ('Mag_Images', 'SWI', 'SIEMENS', 2.0),
+        ('Ax SWAN', 'SWAN', 'GE', 2.0),
+        # 3D T1 by slice spacing, unknown spacing keeps 3DT1
+        ('t1_mprage_sag', 't1_mprage_sag', 'SIEMENS', 1.0),
+        ('t1_mprage_sag', 't1_mprage_sag', 'SIEMENS', 5.0),
+        ('T1 3D BRAVO', 'T1 3D BRAVO', 'GE', np.nan),
+        ('unrelated', 'unrelated', 'UIH', np.nan),
+    ]
+    df = pd.DataFrame(rows, columns=['SeriesDescription', 'ProtocolName', 'Manufacturer', 'SpacingBetweenSlices'])
+    df['pid'] = [str(i % 3) for i in range(len(df))]
+    df['AcquisitionDateTime'] = ['2020-01-01T10:00:00', '2020-09-01T10:00:00', 'garbage'] * (len(df) // 3) + \
+        ['2021-01-01T10:00:00'] * (len(df) % 3)
+    return df
+
+
+def test_vectorized_matches_rowwise():
+    df = marker_table()
+    vectorized = MAP_series_marker(df.copy(), marker='备注').map_series_rule(engine='vectorized')
+    rowwise = MAP_series_marker(df.copy(), marker='备注').map_series_rule(engine='rowwise')
+    assert vectorized['备注'].tolist() == rowwise['备注'].tolist()
+    assert vectorized['StudyRound'].tolist() == rowwise['StudyRound'].tolist()
+
+
+def test_expected_labels():
+    labels = MAP_series_marker(marker_table(), marker='备注').map_series_rule()['备注'].tolist()
+    # Ax T1 FLAIR: T1 is listed after T2Flair and wins
+    assert labels[:7] == ['T2', 'T2Flair', 'T1', 'DWI', 'ADC', 'Others', '']
+    assert labels[7:14] == ['Others', 'Others', 'Others', '', 'Others', 'Others', 'Others']
+    assert labels[14:17] == ['delete'] * 3
+    # Toshiba patterns also let the later match win: Flair T2 is T2
+    assert labels[17:22] == ['T2', 'T2', 'T1', 'T2', '']
+    assert labels[22:25] == ['SWI_Pha', 'SWI', 'SWI']
+    assert labels[25:29] == ['3DT1', 'delete', '3DT1', '']
+
+
+def test_check_parity_reports_no_mismatches():
+    assert MAP_series_marker(marker_table(), marker='备注').check_parity().empty
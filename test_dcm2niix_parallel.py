@@ -0,0 +1,84 @@
+# The dcm2niix driver against a stub executable on PATH
+
+import os
+import stat
+
+from dcm2niix_parallel import order_jobs, read_journal, run_conversions
+
+STUB = '''#!/bin/sh
+# last two arguments are -o's directory and the DICOM directory
+for arg; do out=$src; src=$arg; done
+echo "$src" >> "$STUB_LOG"
+if [ -e "$src/fail_once" ]; then rm "$src/fail_once"; exit 3; fi
+if [ -e "$src/slow" ]; then exec sleep 5; fi
+touch "$out/converted.nii.gz"
+'''
+
+
+def make_tree(root, patients):
+    # patients maps name to the number of 1 KiB DICOM stand-ins
+    for name, files in patients.items():
+        patient = root / '1+Center' / name
+        patient.mkdir(parents=True)
+        for index in range(files):
+            (patient / f'{index}.dcm').write_bytes(b'\0' * 1024)
+    return root
+
+
+def stub_path(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    stub = bin_dir / 'dcm2niix'
+    stub.write_text(STUB)
+    stub.chmod(stub.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('STUB_LOG', str(tmp_path / 'calls.log'))
+    return tmp_path / 'calls.log'
+
+
+def calls(log):
+    return [os.path.basename(line) for line in log.read_text().split()] if log.exists() else []
+
+
+def test_largest_directory_first(tmp_path, monkeypatch):
+    log = stub_path(tmp_path, monkeypatch)
+    source = make_tree(tmp_path / 'dicom', {'1+Small': 1, '2+Large': 5, '3+Medium': 3})
+    jobs = order_jobs([(str(source / '1+Center' / name), '') for name in ['1+Small', '2+Large', '3+Medium']])
+    assert [os.path.basename(subdir) for subdir, _ in jobs] == ['2+Large', '3+Medium', '1+Small']
+    results = run_conversions(source, tmp_path / 'nifti', workers=1)
+    assert calls(log) == ['2+Large', '3+Medium', '1+Small']
+    assert all(result['status'] == 'done' for result in results)
+    assert (tmp_path / 'nifti' / '1+Center' / '2+Large' / 'converted.nii.gz').exists()
+
+
+def test_failed_attempt_is_retried(tmp_path, monkeypatch):
+    log = stub_path(tmp_path, monkeypatch)
+    source = make_tree(tmp_path / 'dicom', {'1+Flaky': 1})
+    (source / '1+Center' / '1+Flaky' / 'fail_once').touch()
+    [result] = run_conversions(source, tmp_path / 'nifti', workers=1, retries=1)
+    assert (result['status'], result['attempts']) == ('done', 2)
+    assert calls(log) == ['1+Flaky', '1+Flaky']
+
+
+def test_timeout(tmp_path, monkeypatch):
+    stub_path(tmp_path, monkeypatch)
+    source = make_tree(tmp_path / 'dicom', {'1+Slow': 1})
+    (source / '1+Center' / '1+Slow' / 'slow').touch()
+    [result] = run_conversions(source, tmp_path / 'nifti', workers=1, timeout=0.5, retries=0)
+    assert result['status'] == 'timeout'
+    # a timed out directory is not journaled as done, so a rerun converts it again
+    assert read_journal(tmp_path / 'nifti' / 'dcm2niix_journal.jsonl') == set()
+
+
+def test_resume_skips_journaled_directories(tmp_path, monkeypatch):
+    log = stub_path(tmp_path, monkeypatch)
+    source = make_tree(tmp_path / 'dicom', {'1+Done': 1, '2+Failed': 1})
+    (source / '1+Center' / '2+Failed' / 'fail_once').touch()
+    first = run_conversions(source, tmp_path / 'nifti', workers=2, retries=0)
+    assert sorted(result['status'] for result in first) == ['done', 'failed']
+    log.unlink()
+    # spelled relative this time, the journal holds absolute paths
+    monkeypatch.chdir(tmp_path)
+    second = run_conversions('dicom', tmp_path / 'nifti', workers=2, retries=0)
+    assert [(os.path.basename(result['source']), result['status']) for result in second] == [('2+Failed', 'done')]
+    assert calls(log) == ['2+Failed']
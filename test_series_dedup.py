@@ -0,0 +1,30 @@
+# Duplicate and target name collision checks of the series deduplicator
+
+import os
+
+from series_dedup import SeriesDeduplicator
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_duplicate_of_accepted_series(tmp_path):
+    first = write(tmp_path / 'a' / 'series.nii.gz', b'same bytes')
+    second = write(tmp_path / 'b' / 'series.nii.gz', b'same bytes')
+    dedup = SeriesDeduplicator(workers=2)
+    checks = dedup.check([(first, str(tmp_path / 'out' / 'x.nii.gz')), (second, str(tmp_path / 'out' / 'y.nii.gz'))])
+    assert checks == [(None, None), ('duplicate', first)]
+
+
+def test_collision_with_earlier_run_and_relative_target(tmp_path, monkeypatch):
+    # the manifest hands register() absolute targets, the scan builds them from --output_dir as typed
+    exported = write(tmp_path / 'src' / 'old.nii.gz', b'exported before')
+    new = write(tmp_path / 'src' / 'new.nii.gz', b'different bytes')
+    monkeypatch.chdir(tmp_path)
+    dedup = SeriesDeduplicator(workers=2)
+    dedup.register([(exported, str(tmp_path / 'sel' / 'MAP-001-001' / 'V1_T1.nii.gz'))])
+    checks = dedup.check([(new, os.path.join('sel', 'MAP-001-001', 'V1_T1.nii.gz'))])
+    assert checks == [('collision', exported)]
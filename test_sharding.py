@@ -0,0 +1,63 @@
+# N shards run as local processes and merged give the single-node outputs
+
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from synthetic_data import generate_dataset
+
+REPO = Path(__file__).resolve().parent
+SHARDS = 3
+
+
+def run(script, *args):
+    subprocess.run([sys.executable, str(REPO / script), *map(str, args), '--log_level', 'off'], check=True, cwd=REPO)
+
+
+def run_shards(script, *args):
+    processes = [subprocess.Popen([sys.executable, str(REPO / script), *map(str, args), '--shard', f'{index}/{SHARDS}',
+                                   '--log_level', 'off'], cwd=REPO)
+                 for index in range(SHARDS)]
+    assert [process.wait() for process in processes] == [0] * SHARDS
+
+
+@pytest.fixture(scope='module')
+def dataset(tmp_path_factory):
+    root = tmp_path_factory.mktemp('sharding')
+    generate_dataset(root / 'nifti', n_series=150, centers=3, series_per_patient=10, seed=1)
+    # re-exports: every patient's first series also turns up as the last one of
+    # the next patient, which is mostly on another shard
+    patients = [sorted(patient.glob('*/*.nii.gz')) for patient in sorted((root / 'nifti').glob('*/*'))]
+    for previous, patient in zip(patients, patients[1:]):
+        shutil.copyfile(previous[0], patient[-1])
+    run('sharding.py', 'census', '--source_dir', root / 'nifti', '--census', root / 'census.json')
+    return root
+
+
+def test_metadata_merge_matches_single_node(dataset):
+    run('metadata_sum.py', '--source_dir', dataset / 'nifti', '--output_dir', dataset / 'metadata')
+    run_shards('metadata_sum.py', '--source_dir', dataset / 'nifti', '--output_dir', dataset / 'metadata_shards',
+               '--census', dataset / 'census.json')
+    run('sharding.py', 'metadata', '--output_dir', dataset / 'metadata_shards', '--shards', SHARDS)
+    single = (dataset / 'metadata' / 'summary_metadata.csv').read_bytes()
+    assert (dataset / 'metadata_shards' / 'summary_metadata.csv').read_bytes() == single
+
+
+@pytest.mark.parametrize('dedup', ['report', 'skip'])
+def test_selection_merge_matches_single_node(dataset, dedup):
+    marker_table = dataset / f'marker_{dedup}' / 'marker_metadata.csv'
+    marker_table.parent.mkdir()
+    run('metadata_sum.py', '--source_dir', dataset / 'nifti', '--output_dir', dataset / f'metadata_{dedup}')
+    run('MAP_series_marker.py', '--input', dataset / f'metadata_{dedup}' / 'summary_metadata.csv', '--output', marker_table)
+    output_dir = dataset / f'selection_{dedup}'
+    args = ['--source_dir', dataset / 'nifti', '--output_dir', output_dir, '--metadata', marker_table,
+            '--dedup', dedup, '--dry_run']
+    run('nii_selection.py', *args, '--plan', dataset / f'single_plan_{dedup}.csv')
+    run_shards('nii_selection.py', *args)
+    run('sharding.py', 'selection', '--output_dir', output_dir, '--shards', SHARDS)
+    single = (dataset / f'single_plan_{dedup}.csv').read_bytes()
+    assert (b',duplicate,' in single) and (dedup != 'skip' or b',skip,duplicate,' in single)
+    assert (output_dir / 'transfer_plan.csv').read_bytes() == single